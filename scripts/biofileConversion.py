@@ -2,26 +2,831 @@
 
 import argparse
 from Bio import SeqIO
+import collections
+import cStringIO
+import glob
+import json
+import math
+import multiprocessing
 import os
+import sys
+import time
 
 
 # Acceptable formats for files and thier extensions
 dictFileExtentions = { "abif":"abif", "ace":"ace", "embl":"embl", "fasta":"fasta", "fastq":"fastq", "fastq-sanger":"fastq", "fastq-solexa":"fastq", "fastq-illumina":"fastq", "genbank":"gbff", "gb":"gbff", "ig":"mase", "imgt":"imgt", "phd":"phd", "pir":"pir", "seqxml":"xsd", "sff":"sff", "sff-trim":"sff", "swiss":"swiss", "tab":"txt", "qual":"qual", "uniprot-xml":"xsd"}
 
+# Formats which can not be cut at record boundaries line by line
+# Binary formats, formats with a file level header / footer, or records which depend on each other
+setSerialFormats = set( [ "abif", "ace", "seqxml", "sff", "sff-trim", "uniprot-xml" ] )
+
+# Line-oriented formats grouped by how a record boundary is found
+setFastqFormats = set( [ "fastq", "fastq-sanger", "fastq-solexa", "fastq-illumina" ] )
+setEndDelimitedFormats = set( [ "embl", "genbank", "gb", "imgt", "swiss" ] )
+
+# Path given to read from stdin or write to stdout
+strStream = "-"
+
+# Number of records given to a worker at a time when converting in parallel
+iChunkRecords = 10000
+
+# Fastq quality encodings used by the fast paths [ ascii offset, min quality, max quality, is solexa scale ]
+dictFastqEncodings = { "fastq":[ 33, 0, 93, False ], "fastq-sanger":[ 33, 0, 93, False ], "fastq-illumina":[ 64, 0, 62, False ], "fastq-solexa":[ 64, -5, 62, True ] }
+
+# Quality character written by the fast path when going from fasta to fastq ( perfect score, as in fasta_to_fastq.py )
+chrPerfectQuality = "~"
+
+# Characters used in the quality translation tables for bad and capped qualities
+chrInvalidQuality = chr( 0 )
+chrTruncatedQuality = chr( 1 )
+
+# Records buffered by the fast paths before writing
+iFastBufferRecords = 5000
+
+# Width of fasta sequence lines ( matches Biopython )
+iFastaWidth = 60
+
+# Extension of the persistent record offset index made next to the input file for --ids
+strIndexExtension = ".idx"
+
+# Default state cache for --batch, remembers what was already converted
+strDefaultStateFile = "biofileConversion_state.json"
+
+# Characters which make the --batch input a glob instead of a manifest
+strGlobCharacters = "*?["
+
+
+def funcIterStartDelimitedRecords( hndlIn, funcIsStart ):
+  """
+  Yield the raw text of records where a line indicates the start of a new record.
+  Any text before the first record is kept with the first record.
+
+  * hndlIn : File handle
+           : Handle to the file being read
+  * funcIsStart : Function
+                : Given the previous and current lines, returns True if the current line starts a record
+  """
+
+  lsRecord = []
+  strPrevious = ""
+  for strLine in hndlIn:
+    if funcIsStart( strPrevious, strLine ) and lsRecord:
+      yield "".join( lsRecord )
+      lsRecord = []
+    lsRecord.append( strLine )
+    strPrevious = strLine
+  if lsRecord:
+    yield "".join( lsRecord )
+
+
+def funcIterEndDelimitedRecords( hndlIn ):
+  """
+  Yield the raw text of records which end with a "//" line ( genbank, embl, swiss ).
+
+  * hndlIn : File handle
+           : Handle to the file being read
+  """
+
+  lsRecord = []
+  for strLine in hndlIn:
+    lsRecord.append( strLine )
+    if strLine[ :2 ] == "//":
+      yield "".join( lsRecord )
+      lsRecord = []
+  if lsRecord:
+    yield "".join( lsRecord )
+
+
+def funcIterFastqRecords( hndlIn ):
+  """
+  Yield the raw text of fastq records.
+  Sequence and quality may be wrapped so the quality is read until it is as long as the sequence.
+
+  * hndlIn : File handle
+           : Handle to the file being read
+  """
+
+  lsRecord = []
+  # 0 = title, 1 = sequence, 2 = quality
+  iState = 0
+  iSeqLength = 0
+  iQualLength = 0
+  for strLine in hndlIn:
+    lsRecord.append( strLine )
+    if iState == 0:
+      iState = 1
+      iSeqLength = 0
+    elif iState == 1:
+      if strLine[ 0 ] == "+":
+        iState = 2
+        iQualLength = 0
+      else:
+        iSeqLength = iSeqLength + len( strLine.rstrip() )
+    else:
+      iQualLength = iQualLength + len( strLine.rstrip() )
+      if iQualLength >= iSeqLength:
+        yield "".join( lsRecord )
+        lsRecord = []
+        iState = 0
+  if lsRecord:
+    yield "".join( lsRecord )
+
+
+def funcIterRecords( hndlIn, strFormat ):
+  """
+  Yield the raw text of each record in a line-oriented file.
+
+  * hndlIn : File handle
+           : Handle to the file being read
+  * strFormat : String
+              : Format of the file ( key in dictFileExtentions )
+  """
+
+  if strFormat in setFastqFormats:
+    return funcIterFastqRecords( hndlIn )
+  if strFormat in setEndDelimitedFormats:
+    return funcIterEndDelimitedRecords( hndlIn )
+  if strFormat == "tab":
+    return funcIterStartDelimitedRecords( hndlIn, lambda strPrevious, strLine: True )
+  if strFormat == "phd":
+    return funcIterStartDelimitedRecords( hndlIn, lambda strPrevious, strLine: strLine.startswith( "BEGIN_SEQUENCE" ) )
+  if strFormat == "ig":
+    return funcIterStartDelimitedRecords( hndlIn, lambda strPrevious, strLine: strLine[ :1 ] == ";" and not strPrevious[ :1 ] == ";" )
+  # fasta, pir, qual
+  return funcIterStartDelimitedRecords( hndlIn, lambda strPrevious, strLine: strLine[ :1 ] == ">" )
+
+
+def funcIterChunks( iterRecords, iRecords ):
+  """
+  Group raw records into chunks of text.
+
+  * iterRecords : Iterator
+                : Raw text of records
+  * iRecords : Integer
+             : Number of records per chunk
+  """
+
+  lsChunk = []
+  for strRecord in iterRecords:
+    lsChunk.append( strRecord )
+    if len( lsChunk ) >= iRecords:
+      yield "".join( lsChunk )
+      lsChunk = []
+  if lsChunk:
+    yield "".join( lsChunk )
+
+
+def funcIterFastaRaw( hndlIn ):
+  """
+  Yield [ title, sequence ] for each fasta record working directly on the raw lines.
+
+  * hndlIn : File handle
+           : Handle to the fasta file
+  """
+
+  strTitle = None
+  lsSeq = []
+  for strLine in hndlIn:
+    if strLine[ :1 ] == ">":
+      if strTitle is not None:
+        yield [ strTitle, "".join( lsSeq ).replace( " ", "" ).replace( "\r", "" ) ]
+      strTitle = strLine[ 1: ].rstrip()
+      lsSeq = []
+    elif strTitle is not None:
+      lsSeq.append( strLine.rstrip() )
+  if strTitle is not None:
+    yield [ strTitle, "".join( lsSeq ).replace( " ", "" ).replace( "\r", "" ) ]
+
+
+def funcIterFastqRaw( hndlIn ):
+  """
+  Yield [ title, sequence, quality ] for each fastq record working directly on the raw lines.
+  Wrapped sequence and quality lines are joined.
+
+  * hndlIn : File handle
+           : Handle to the fastq file
+  """
+
+  iterLines = iter( hndlIn )
+  for strTitle in iterLines:
+    if not strTitle[ :1 ] == "@":
+      if not strTitle.strip():
+        continue
+      raise ValueError( "Fastq records should start with @. Line = " + strTitle )
+    lsSeq = []
+    for strLine in iterLines:
+      if strLine[ :1 ] == "+":
+        break
+      lsSeq.append( strLine.rstrip() )
+    else:
+      raise ValueError( "End of file without quality information. Record = " + strTitle )
+    strSeq = "".join( lsSeq )
+    try:
+      strQual = next( iterLines ).rstrip()
+      while len( strQual ) < len( strSeq ):
+        strQual = strQual + next( iterLines ).rstrip()
+    except StopIteration:
+      raise ValueError( "End of file without complete quality information. Record = " + strTitle )
+    if not len( strQual ) == len( strSeq ):
+      raise ValueError( "Lengths of sequence and quality values differ. Record = " + strTitle )
+    yield [ strTitle[ 1: ].rstrip(), strSeq, strQual ]
+
+
+def funcMakeQualityTable( strFormatIn, strFormatOut ):
+  """
+  Make a 256 character str.translate table re-encoding the quality characters of one fastq variant to another.
+  Characters not valid for the input are mapped to chrInvalidQuality.
+  Qualities too high for the output are mapped to chrTruncatedQuality.
+
+  * strFormatIn : String
+                : Input fastq format
+  * strFormatOut : String
+                 : Output fastq format
+  """
+
+  iOffsetIn, iMinIn, iMaxIn, fSolexaIn = dictFastqEncodings[ strFormatIn ]
+  iOffsetOut, iMinOut, iMaxOut, fSolexaOut = dictFastqEncodings[ strFormatOut ]
+  lsTable = []
+  for iAscii in xrange( 256 ):
+    iQuality = iAscii - iOffsetIn
+    if iQuality < iMinIn or iQuality > iMaxIn:
+      lsTable.append( chrInvalidQuality )
+      continue
+    # Move between the solexa and phred scales
+    if fSolexaIn and not fSolexaOut:
+      iQuality = int( round( 10 * math.log10( 10 ** ( iQuality / 10.0 ) + 1 ) ) )
+    elif fSolexaOut and not fSolexaIn:
+      iQuality = -5 if iQuality == 0 else int( round( max( -5.0, 10 * math.log10( 10 ** ( iQuality / 10.0 ) - 1 ) ) ) )
+    if iQuality > iMaxOut:
+      lsTable.append( chrTruncatedQuality )
+    else:
+      lsTable.append( chr( iOffsetOut + max( iMinOut, iQuality ) ) )
+  return "".join( lsTable )
+
+
+def funcFastFastaToFastq( hndlIn, strFormatIn, hndlOut, strFormatOut ):
+  """
+  Fast path, fasta to any fastq variant giving every base a perfect quality.
+  Returns the number of records converted.
+
+  * hndlIn : File handle
+           : Handle to the input file
+  * strFormatIn : String
+                : Input format
+  * hndlOut : File handle
+            : Handle to the output file
+  * strFormatOut : String
+                 : Output format
+  """
+
+  iCount = 0
+  lsBuffer = []
+  dictQualities = {}
+  for strTitle, strSeq in funcIterFastaRaw( hndlIn ):
+    iLength = len( strSeq )
+    strQual = dictQualities.get( iLength )
+    if strQual is None:
+      strQual = chrPerfectQuality * iLength
+      dictQualities[ iLength ] = strQual
+    lsBuffer.append( "@%s\n%s\n+\n%s\n" % ( strTitle, strSeq, strQual ) )
+    iCount = iCount + 1
+    # Cached qualities are dropped with the buffer so long contigs do not pile up
+    if len( lsBuffer ) >= iFastBufferRecords:
+      hndlOut.write( "".join( lsBuffer ) )
+      lsBuffer = []
+      dictQualities = {}
+  hndlOut.write( "".join( lsBuffer ) )
+  return iCount
+
+
+def funcFastFastqToFasta( hndlIn, strFormatIn, hndlOut, strFormatOut ):
+  """
+  Fast path, any fastq variant to fasta. Sequences are wrapped as Biopython does.
+  Returns the number of records converted.
+
+  * hndlIn : File handle
+           : Handle to the input file
+  * strFormatIn : String
+                : Input format
+  * hndlOut : File handle
+            : Handle to the output file
+  * strFormatOut : String
+                 : Output format
+  """
+
+  iCount = 0
+  lsBuffer = []
+  for strTitle, strSeq, strQual in funcIterFastqRaw( hndlIn ):
+    lsBuffer.append( ">" + strTitle + "\n" )
+    lsBuffer.extend( [ strSeq[ iStart : iStart + iFastaWidth ] + "\n" for iStart in xrange( 0, len( strSeq ), iFastaWidth ) ] )
+    iCount = iCount + 1
+    if not iCount % iFastBufferRecords:
+      hndlOut.write( "".join( lsBuffer ) )
+      lsBuffer = []
+  hndlOut.write( "".join( lsBuffer ) )
+  return iCount
+
+
+def funcFastFastqToFastq( hndlIn, strFormatIn, hndlOut, strFormatOut ):
+  """
+  Fast path, re-encode qualities between fastq variants with a precomputed translate table.
+  Qualities above what the output can hold are capped with a warning.
+  Returns the number of records converted.
+
+  * hndlIn : File handle
+           : Handle to the input file
+  * strFormatIn : String
+                : Input format
+  * hndlOut : File handle
+            : Handle to the output file
+  * strFormatOut : String
+                 : Output format
+  """
+
+  strTable = funcMakeQualityTable( strFormatIn, strFormatOut )
+  chrMaxOut = chr( dictFastqEncodings[ strFormatOut ][ 0 ] + dictFastqEncodings[ strFormatOut ][ 2 ] )
+  fTruncated = False
+  iCount = 0
+  lsBuffer = []
+  for strTitle, strSeq, strQual in funcIterFastqRaw( hndlIn ):
+    strQual = strQual.translate( strTable )
+    if chrInvalidQuality in strQual:
+      raise ValueError( "Invalid character in quality string for " + strFormatIn + ". Record = " + strTitle )
+    if chrTruncatedQuality in strQual:
+      strQual = strQual.replace( chrTruncatedQuality, chrMaxOut )
+      fTruncated = True
+    lsBuffer.append( "@%s\n%s\n+\n%s\n" % ( strTitle, strSeq, strQual ) )
+    iCount = iCount + 1
+    if len( lsBuffer ) >= iFastBufferRecords:
+      hndlOut.write( "".join( lsBuffer ) )
+      lsBuffer = []
+  hndlOut.write( "".join( lsBuffer ) )
+  if fTruncated:
+    print >> sys.stderr, "Warning: data loss, qualities were capped at the maximum for " + strFormatOut
+  return iCount
+
+
+def funcGetFastPath( strFormatIn, strFormatOut ):
+  """
+  Return the fast path function for a pair of formats, None if the pair needs Biopython.
+
+  * strFormatIn : String
+                : Input format
+  * strFormatOut : String
+                 : Output format
+  """
+
+  if strFormatIn == "fasta" and strFormatOut in setFastqFormats:
+    return funcFastFastaToFastq
+  if strFormatIn in setFastqFormats and strFormatOut == "fasta":
+    return funcFastFastqToFasta
+  if strFormatIn in setFastqFormats and strFormatOut in setFastqFormats:
+    return funcFastFastqToFastq
+  return None
+
+
+def funcConvertHandles( hndlIn, strFormatIn, hndlOut, strFormatOut, fFast = True ):
+  """
+  Convert between open handles, using a fast path when one exists for the formats.
+  Returns the number of records converted.
+
+  * hndlIn : File handle
+           : Handle to the input file
+  * strFormatIn : String
+                : Input format
+  * hndlOut : File handle
+            : Handle to the output file
+  * strFormatOut : String
+                 : Output format
+  * fFast : Boolean
+          : False forces conversion through Biopython
+  """
+
+  funcFast = funcGetFastPath( strFormatIn, strFormatOut ) if fFast else None
+  if funcFast:
+    return funcFast( hndlIn, strFormatIn, hndlOut, strFormatOut )
+  return SeqIO.convert( hndlIn, strFormatIn, hndlOut, strFormatOut )
+
+
+def funcBenchmark( strFileIn, strFormatIn, strFormatOut ):
+  """
+  Time converting a file with the fast path and with Biopython and print records per second for each.
+  Output is thrown away.
+
+  * strFileIn : String
+              : Path to the input file
+  * strFormatIn : String
+                : Input format
+  * strFormatOut : String
+                 : Output format
+  """
+
+  for strEngine, fFast in [ [ "fast", True ], [ "biopython", False ] ]:
+    if fFast and not funcGetFastPath( strFormatIn, strFormatOut ):
+      print "Engine " + strFormatIn + " to " + strFormatOut + ": no fast path for these formats"
+      continue
+    with open( strFileIn, "rb" if strFormatIn in setSerialFormats else "rU" ) as hndlIn:
+      with open( os.devnull, "w" ) as hndlOut:
+        dStart = time.time()
+        try:
+          iCount = funcConvertHandles( hndlIn, strFormatIn, hndlOut, strFormatOut, fFast )
+        except ValueError as errConvert:
+          print "Engine " + strEngine + ": failed ( " + str( errConvert ) + " )"
+          continue
+        dSeconds = max( time.time() - dStart, 1e-9 )
+    print "Engine %s: %i records in %.2f seconds, %.0f records/sec" % ( strEngine, iCount, dSeconds, iCount / dSeconds )
+
+
+def funcConvertChunk( strChunk, strFormatIn, strFormatOut, fFast ):
+  """
+  Convert a chunk of records held in memory. Ran in the worker processes.
+  Returns [ number of records converted, converted text ].
+
+  * strChunk : String
+             : Raw text of whole records
+  * strFormatIn : String
+                : Input format
+  * strFormatOut : String
+                 : Output format
+  * fFast : Boolean
+          : False forces conversion through Biopython
+  """
+
+  hndlOut = cStringIO.StringIO()
+  iCount = funcConvertHandles( cStringIO.StringIO( strChunk ), strFormatIn, hndlOut, strFormatOut, fFast )
+  return [ iCount, hndlOut.getvalue() ]
+
+
+def funcOpen( strPath, strMode ):
+  """
+  Open a file, or return stdin / stdout if the path is "-".
+
+  * strPath : String
+            : Path to open or "-"
+  * strMode : String
+            : Mode to open the file in
+  """
+
+  if strPath == strStream:
+    return sys.stdout if "w" in strMode else sys.stdin
+  return open( strPath, strMode )
+
+
+def funcConvertParallel( hndlIn, strFormatIn, hndlOut, strFormatOut, iThreads, fFast = True ):
+  """
+  Convert a file by cutting it at record boundaries and converting the chunks in a process pool.
+  Chunks are written in their original order so the output matches the serial conversion.
+  Only a few chunks per worker are held in memory at a time.
+  Returns the number of records converted.
+
+  * hndlIn : File handle
+           : Handle to the input file
+  * strFormatIn : String
+                : Input format
+  * hndlOut : File handle
+            : Handle to the output file
+  * strFormatOut : String
+                 : Output format
+  * iThreads : Integer
+             : Number of worker processes
+  * fFast : Boolean
+          : False forces conversion through Biopython
+  """
+
+  iCounts = 0
+  poolWorkers = multiprocessing.Pool( iThreads )
+  dqPending = collections.deque()
+  try:
+    for strChunk in funcIterChunks( funcIterRecords( hndlIn, strFormatIn ), iChunkRecords ):
+      dqPending.append( poolWorkers.apply_async( funcConvertChunk, ( strChunk, strFormatIn, strFormatOut, fFast ) ) )
+      # Bound the chunks in flight, write the oldest when full
+      if len( dqPending ) >= 2 * iThreads:
+        iCount, strConverted = dqPending.popleft().get()
+        iCounts = iCounts + iCount
+        hndlOut.write( strConverted )
+    while dqPending:
+      iCount, strConverted = dqPending.popleft().get()
+      iCounts = iCounts + iCount
+      hndlOut.write( strConverted )
+    poolWorkers.close()
+  except:
+    poolWorkers.terminate()
+    raise
+  finally:
+    poolWorkers.join()
+  return iCounts
+
+
+def funcReadIds( strIdFile ):
+  """
+  Read record ids, one per line. Blank lines are skipped and order is kept.
+
+  * strIdFile : String
+              : Path to the file of ids
+  """
+
+  with open( strIdFile, "r" ) as hndlIds:
+    return [ strId.strip() for strId in hndlIds if strId.strip() ]
+
+
+def funcConvertIds( strFileIn, strFormatIn, hndlOut, strFormatOut, lsIds, fFast = True ):
+  """
+  Convert only the records with the given ids, found through a persistent on-disk offset index.
+  The index ( SeqIO.index_db ) is made next to the input the first time it is needed and
+  remade if the input changes after, later runs seek straight to the records.
+  Returns [ number of records converted, list of ids not found ].
+
+  * strFileIn : String
+              : Path to the input file
+  * strFormatIn : String
+                : Input format
+  * hndlOut : File handle
+            : Handle to the output file
+  * strFormatOut : String
+                 : Output format
+  * lsIds : List
+          : Ids of the records to convert, in the order to write them
+  * fFast : Boolean
+          : False forces conversion through Biopython
+  """
+
+  strIndex = strFileIn + strIndexExtension
+  if os.path.exists( strIndex ) and ( os.path.getmtime( strIndex ) < os.path.getmtime( strFileIn ) ):
+    os.remove( strIndex )
+  dbRecords = SeqIO.index_db( strIndex, strFileIn, strFormatIn )
+  try:
+    lsFound = [ strId for strId in lsIds if strId in dbRecords ]
+    lsMissing = [ strId for strId in lsIds if not strId in dbRecords ]
+
+    # Binary and whole file formats go record by record through Biopython
+    if strFormatIn in setSerialFormats or strFormatOut in setSerialFormats:
+      return [ SeqIO.write( ( dbRecords[ strId ] for strId in lsFound ), hndlOut, strFormatOut ), lsMissing ]
+
+    # Line-oriented formats pull the raw text of the records and convert it in chunks
+    iCounts = 0
+    for strChunk in funcIterChunks( ( dbRecords.get_raw( strId ) for strId in lsFound ), iChunkRecords ):
+      iCounts = iCounts + funcConvertHandles( cStringIO.StringIO( strChunk ), strFormatIn, hndlOut, strFormatOut, fFast )
+    return [ iCounts, lsMissing ]
+  finally:
+    dbRecords.close()
+
+
+def funcOutputPath( strFileIn, strFormatOut, strOutDir = None ):
+  """
+  Default output path, <input_file>-conv.<ext> next to the input or in the given directory.
+
+  * strFileIn : String
+              : Path to the input file
+  * strFormatOut : String
+                 : Output format
+  * strOutDir : String
+              : Optional directory to write in
+  """
+
+  strFileOut = os.path.splitext( strFileIn )[ 0 ] + "-conv." + dictFileExtentions[ strFormatOut ]
+  if strOutDir:
+    strFileOut = os.path.join( strOutDir, os.path.basename( strFileOut ) )
+  return strFileOut
+
+
+def funcReadBatch( strBatch, strFormatOut, strOutDir = None ):
+  """
+  Read the files to convert in batch mode. Returns [ [ input path, output path ], ... ].
+  The batch is a glob ( if it has glob characters ) or a manifest of one input per line
+  with an optional tab delimited output path.
+
+  * strBatch : String
+             : Glob or path to a manifest file
+  * strFormatOut : String
+                 : Output format
+  * strOutDir : String
+              : Optional directory to write in when the output is not given
+  """
+
+  if any( [ chrGlob in strBatch for chrGlob in strGlobCharacters ] ):
+    return [ [ strFileIn, funcOutputPath( strFileIn, strFormatOut, strOutDir ) ] for strFileIn in sorted( glob.glob( strBatch ) ) ]
+
+  llstrFiles = []
+  with open( strBatch, "r" ) as hndlManifest:
+    for strLine in hndlManifest:
+      lstrLine = strLine.rstrip( "\r\n" ).split( "\t" )
+      if not lstrLine[ 0 ].strip() or lstrLine[ 0 ][ 0 ] == "#":
+        continue
+      strFileOut = lstrLine[ 1 ] if len( lstrLine ) > 1 and lstrLine[ 1 ] else funcOutputPath( lstrLine[ 0 ], strFormatOut, strOutDir )
+      llstrFiles.append( [ lstrLine[ 0 ], strFileOut ] )
+  return llstrFiles
+
+
+def funcFingerprint( strPath ):
+  """
+  Cheap fingerprint of a file [ size, mtime ], None if the file does not exist.
+
+  * strPath : String
+            : Path to the file
+  """
+
+  if not os.path.exists( strPath ):
+    return None
+  statFile = os.stat( strPath )
+  return [ statFile.st_size, statFile.st_mtime ]
+
+
+def funcIsCurrent( dictState, strFileIn, strFileOut, strFormatIn, strFormatOut ):
+  """
+  True if the state cache says the output was made from the input as it is now and is untouched since.
+
+  * dictState : Dictionary
+              : State cache { input path : { "input", "output", "output_fingerprint", "formats" } }
+  * strFileIn : String
+              : Path to the input file
+  * strFileOut : String
+               : Path to the output file
+  * strFormatIn : String
+                : Input format
+  * strFormatOut : String
+                 : Output format
+  """
+
+  dictEntry = dictState.get( os.path.abspath( strFileIn ) )
+  if not dictEntry:
+    return False
+  return ( dictEntry[ "input" ] == funcFingerprint( strFileIn ) and
+           dictEntry[ "output" ] == os.path.abspath( strFileOut ) and
+           dictEntry[ "output_fingerprint" ] == funcFingerprint( strFileOut ) and
+           dictEntry[ "formats" ] == [ strFormatIn, strFormatOut ] )
+
+
+def funcConvertBatchFile( strFileIn, strFileOut, strFormatIn, strFormatOut, fFast ):
+  """
+  Convert one file of a batch. Ran in the worker processes.
+  Returns [ input path, output path, records, seconds, worker name, error or None ].
+
+  * strFileIn : String
+              : Path to the input file
+  * strFileOut : String
+               : Path to the output file
+  * strFormatIn : String
+                : Input format
+  * strFormatOut : String
+                 : Output format
+  * fFast : Boolean
+          : False forces conversion through Biopython
+  """
+
+  strWorker = multiprocessing.current_process().name
+  dStart = time.time()
+  try:
+    with open( strFileIn, "rb" if strFormatIn in setSerialFormats else "rU" ) as hndlIn:
+      with open( strFileOut, "wb" if strFormatOut in setSerialFormats else "w" ) as hndlOut:
+        iCount = funcConvertHandles( hndlIn, strFormatIn, hndlOut, strFormatOut, fFast )
+  except Exception as errConvert:
+    return [ strFileIn, strFileOut, 0, time.time() - dStart, strWorker, str( errConvert ) ]
+  return [ strFileIn, strFileOut, iCount, time.time() - dStart, strWorker, None ]
+
+
+def funcConvertBatch( llstrFiles, strFormatIn, strFormatOut, iThreads, strStateFile, hndlLog, fFast = True ):
+  """
+  Convert many files in a process pool, skipping those whose output is current in the state cache.
+  Ends with a summary of records/sec per worker.
+  Returns [ number of records converted, number of files which failed ].
+
+  * llstrFiles : List
+               : [ [ input path, output path ], ... ]
+  * strFormatIn : String
+                : Input format
+  * strFormatOut : String
+                 : Output format
+  * iThreads : Integer
+             : Number of worker processes
+  * strStateFile : String
+                 : Path to the JSON state cache
+  * hndlLog : File handle
+            : Where to write progress and the summary
+  * fFast : Boolean
+          : False forces conversion through Biopython
+  """
+
+  dictState = {}
+  if os.path.exists( strStateFile ):
+    with open( strStateFile, "r" ) as hndlState:
+      dictState = json.load( hndlState )
+
+  # Only convert what changed since the last run
+  llstrTodo = [ lstrFiles for lstrFiles in llstrFiles if not funcIsCurrent( dictState, lstrFiles[ 0 ], lstrFiles[ 1 ], strFormatIn, strFormatOut ) ]
+  print >> hndlLog, "Batch: %i files, %i up to date, %i to convert" % ( len( llstrFiles ), len( llstrFiles ) - len( llstrTodo ), len( llstrTodo ) )
+
+  # { worker : [ files, records, seconds ] }
+  dictWorkers = {}
+  lstrFailed = []
+  iCounts = 0
+  poolWorkers = multiprocessing.Pool( max( 1, iThreads ) )
+  try:
+    lResults = [ poolWorkers.apply_async( funcConvertBatchFile, ( strFileIn, strFileOut, strFormatIn, strFormatOut, fFast ) ) for strFileIn, strFileOut in llstrTodo ]
+    for resultFile in lResults:
+      strFileIn, strFileOut, iCount, dSeconds, strWorker, strError = resultFile.get()
+      if strError:
+        print >> hndlLog, "Failed: " + strFileIn + " ( " + strError + " )"
+        lstrFailed.append( strFileIn )
+        dictState.pop( os.path.abspath( strFileIn ), None )
+        continue
+      print >> hndlLog, "Converted %i records: %s -> %s" % ( iCount, strFileIn, strFileOut )
+      iCounts = iCounts + iCount
+      lWorker = dictWorkers.setdefault( strWorker, [ 0, 0, 0.0 ] )
+      lWorker[ 0 ] = lWorker[ 0 ] + 1
+      lWorker[ 1 ] = lWorker[ 1 ] + iCount
+      lWorker[ 2 ] = lWorker[ 2 ] + dSeconds
+      dictState[ os.path.abspath( strFileIn ) ] = { "input":funcFingerprint( strFileIn ), "output":os.path.abspath( strFileOut ),
+                                                    "output_fingerprint":funcFingerprint( strFileOut ), "formats":[ strFormatIn, strFormatOut ] }
+    poolWorkers.close()
+  except:
+    poolWorkers.terminate()
+    raise
+  finally:
+    poolWorkers.join()
+    # Write the state even on failure so finished files are not redone
+    strStateTemp = strStateFile + ".tmp"
+    with open( strStateTemp, "w" ) as hndlState:
+      json.dump( dictState, hndlState, sort_keys = True, indent = 2 )
+    os.rename( strStateTemp, strStateFile )
+
+  # Summary
+  print >> hndlLog, "#### Summary ####"
+  for strWorker in sorted( dictWorkers ):
+    iFiles, iRecords, dSeconds = dictWorkers[ strWorker ]
+    print >> hndlLog, "%s: %i files, %i records, %.2f seconds, %.0f records/sec" % ( strWorker, iFiles, iRecords, dSeconds, iRecords / max( dSeconds, 1e-9 ) )
+  print >> hndlLog, "Failed files: " + str( len( lstrFailed ) )
+  return [ iCounts, len( lstrFailed ) ]
+
+
 # Get commandline
 argp = argparse.ArgumentParser( prog = "biofileConversion.py", description = "Converts bioinformatics file formats" )
-argp.add_argument( "strFileIn", metavar = "input_file", help = "Input file to convert." )
+argp.add_argument( "strFileIn", metavar = "input_file", help = "Input file to convert. Use - to read from stdin. With --batch, a manifest or a quoted glob." )
 argp.add_argument( "strFormatIn", metavar = "input_file_format", choices = dictFileExtentions.keys(), help = "Input file format. Choices are " + str(
 dictFileExtentions.keys()) )
 argp.add_argument( "strFormatOut", metavar = "output_file_format", choices = dictFileExtentions.keys(), help = "Output file format. Choices are " + str(dictFileExtentions.keys()) )
+argp.add_argument( "--threads", metavar = "Threads", dest = "iThreads", type = int, default = 1, help = "Number of processes to convert with. Line-oriented formats are cut at record boundaries and converted in chunks; other formats are converted serially." )
+argp.add_argument( "-o", "--output", metavar = "Output_File", dest = "strFileOut", default = None, help = "File to write to. Use - to write to stdout. Defaults to <input_file>-conv.<ext>, or stdout when reading from stdin." )
+argp.add_argument( "--benchmark", dest = "fBenchmark", action = "store_true", default = False, help = "Time the fast path against Biopython on the input and report records/sec instead of converting." )
+argp.add_argument( "--no_fast", dest = "fFast", action = "store_false", default = True, help = "Always convert through Biopython, even when a fast path exists for the formats." )
+argp.add_argument( "--ids", metavar = "Id_File", dest = "strIdFile", default = None, help = "Only convert the records with these ids ( one per line ). An offset index ( <input_file>" + strIndexExtension + " ) is made the first time so later runs seek to the records." )
+argp.add_argument( "--batch", dest = "fBatch", action = "store_true", default = False, help = "Convert many files in a process pool ( --threads workers ). input_file is a glob or a manifest of one input per line ( optional tab delimited output path ). With -o, outputs go in that directory. Files whose output is current in the state cache are skipped." )
+argp.add_argument( "--state", metavar = "State_File", dest = "strStateFile", default = strDefaultStateFile, help = "State cache used by --batch to skip files already converted." )
 args = argp.parse_args()
 
+# Benchmark reads the file once per engine
+if args.fBenchmark:
+  if args.strFileIn == strStream:
+    print "Benchmarking needs an input file, not a stream."
+    exit( 1 )
+  funcBenchmark( args.strFileIn, args.strFormatIn, args.strFormatOut )
+  exit( 0 )
 
-# Parse, format, and save
-print "Converting file: " + args.strFileIn
-print "Input Format: " + args.strFormatIn
-print "Output Format: " + args.strFormatOut
+# Batch mode reports its own summary
+if args.fBatch:
+  if args.strFileOut and not os.path.isdir( args.strFileOut ):
+    os.makedirs( args.strFileOut )
+  iCounts, iFailed = funcConvertBatch( funcReadBatch( args.strFileIn, args.strFormatOut, args.strFileOut ), args.strFormatIn, args.strFormatOut, args.iThreads, args.strStateFile, sys.stdout, args.fFast )
+  exit( 1 if iFailed else 0 )
+
+# Indexing needs to seek in the input
+if args.strIdFile and args.strFileIn == strStream:
+  print "Converting by ids needs an input file, not a stream."
+  exit( 1 )
+
+# Default output is next to the input, streams stay streams
+strFileOut = args.strFileOut
+if strFileOut is None:
+  strFileOut = strStream if args.strFileIn == strStream else funcOutputPath( args.strFileIn, args.strFormatOut )
 
-iCounts = SeqIO.convert( args.strFileIn, args.strFormatIn, os.path.splitext(args.strFileIn)[0] + "-conv." + dictFileExtentions[args.strFormatOut], args.strFormatOut )
-print "Converted %i records" % iCounts
+# Keep messages out of the converted data when it goes to stdout
+hndlLog = sys.stderr if strFileOut == strStream else sys.stdout
+
+
+# Parse, format, and save
+print >> hndlLog, "Converting file: " + args.strFileIn
+print >> hndlLog, "Input Format: " + args.strFormatIn
+print >> hndlLog, "Output Format: " + args.strFormatOut
+print >> hndlLog, "Output File: " + strFileOut
 
+# Records are streamed from handle to handle so memory does not grow with the file
+fParallel = ( args.iThreads > 1 ) and not ( args.strFormatIn in setSerialFormats or args.strFormatOut in setSerialFormats )
+hndlIn = None if args.strIdFile else funcOpen( args.strFileIn, "rb" if args.strFormatIn in setSerialFormats else "rU" )
+hndlOut = funcOpen( strFileOut, "wb" if args.strFormatOut in setSerialFormats else "w" )
+lsMissing = []
+try:
+  if args.strIdFile:
+    iCounts, lsMissing = funcConvertIds( args.strFileIn, args.strFormatIn, hndlOut, args.strFormatOut, funcReadIds( args.strIdFile ), args.fFast )
+  elif fParallel:
+    iCounts = funcConvertParallel( hndlIn, args.strFormatIn, hndlOut, args.strFormatOut, args.iThreads, args.fFast )
+  else:
+    iCounts = funcConvertHandles( hndlIn, args.strFormatIn, hndlOut, args.strFormatOut, args.fFast )
+finally:
+  if hndlIn and not hndlIn is sys.stdin:
+    hndlIn.close()
+  if hndlOut is sys.stdout:
+    hndlOut.flush()
+  else:
+    hndlOut.close()
+print >> hndlLog, "Converted %i records" % iCounts
+if lsMissing:
+  print >> hndlLog, "Ids not found in the input ( %i ): %s" % ( len( lsMissing ), " ".join( lsMissing ) )
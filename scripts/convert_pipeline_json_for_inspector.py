@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
 import json
+import multiprocessing.pool
 import shutil
 import os
 import sys
@@ -12,59 +14,310 @@ c_STR_INSPECTOR_FP = "FP"
 c_STR_INSPECTOR_FN = "FN"
 c_STR_INSPECTOR_RNA_BAM = u"RNA"
 c_STR_INSPECTOR_DNA_BAM = u"DNA"
+c_STR_INSPECTOR_JSON = "pipeline_inspector.json"
+c_STR_INDEX_EXT = ".bai"
+c_I_STAT_THREADS = 32
+# Links checked and made together in incremental mode, bounds the memory they hold
+c_I_LINK_BATCH = 10000
+# Bytes read at a time while streaming the JSON
+c_I_READ_CHUNK = 1024 * 1024
+
+
+def func_iter_json_mapping( hndl_json ):
+  """
+  Yield ( key, value ) of the top level object of a JSON file one entry at a time,
+  holding only about one entry in memory instead of the whole document.
+
+  * hndl_json : File handle
+              : JSON file with an object at the top level
+  """
+
+  decoder_json = json.JSONDecoder()
+  str_buffer = ""
+  i_pos = 0
+  i_chunk = c_I_READ_CHUNK
+  f_eof = False
+  # What comes next: {, first key or }, :, value, , or }, key, end ( only whitespace )
+  str_expect = "{"
+  str_key = None
+  while True:
+    i_pos = json.decoder.WHITESPACE.match( str_buffer, i_pos ).end()
+    if i_pos >= len( str_buffer ):
+      if f_eof:
+        if str_expect in [ "{", "end" ]:
+          return
+        raise ValueError( "JSON ended inside the top level object." )
+      str_read = hndl_json.read( i_chunk )
+      f_eof = not str_read
+      str_buffer = str_buffer[ i_pos: ] + str_read
+      i_pos = 0
+      continue
+
+    str_char = str_buffer[ i_pos ]
+    if str_expect in [ "first key", "," ] and str_char == "}":
+      i_pos = i_pos + 1
+      str_expect = "end"
+      continue
+    if str_expect in [ "{", ":", ",", "end" ]:
+      if str_char != str_expect:
+        raise ValueError( "Expected " + str_expect + " at " + repr( str_buffer[ i_pos : i_pos + 20 ] ) )
+      i_pos = i_pos + 1
+      str_expect = { "{":"first key", ":":"value", ",":"key" }[ str_expect ]
+      continue
+
+    # A key or value, read more until it is complete ( a number cut by the end of the buffer parses as a shorter one )
+    try:
+      obj_value, i_end = decoder_json.raw_decode( str_buffer, i_pos )
+      f_complete = f_eof or ( i_end < len( str_buffer ) and str_buffer[ i_end ] in " \t\n\r,:}" )
+    except ValueError:
+      if f_eof:
+        raise
+      f_complete = False
+    if not f_complete:
+      str_read = hndl_json.read( i_chunk )
+      f_eof = not str_read
+      str_buffer = str_buffer[ i_pos: ] + str_read
+      i_pos = 0
+      i_chunk = i_chunk * 2
+      continue
+    i_pos = i_end
+    i_chunk = c_I_READ_CHUNK
+    if str_expect != "value":
+      if not isinstance( obj_value, basestring ):
+        raise ValueError( "JSON object keys must be strings." )
+      str_key = obj_value
+      str_expect = ":"
+    else:
+      yield ( str_key, obj_value )
+      str_expect = ","
+
+
+def func_dump_entry( str_key, obj_value ):
+  """
+  One top level entry written as json.dumps( sort_keys = True, indent = 2 ) writes it inside the top level object.
+
+  * str_key : String
+            : Key
+  * obj_value : Object
+              : Value
+  """
+
+  return "  " + json.dumps( str_key ) + ": " + json.dumps( obj_value, sort_keys=True, indent=2 ).replace( "\n", "\n  " )
+
+
+def func_convert_sample( dict_sample, str_output_dir ):
+  """
+  Point the DNA and RNA bams of a sample to links in the output directory.
+  Returns the links it needs as [ [ str_from_path, str_to_path ] ], bams and their indices.
+
+  * dict_sample : Dictionary
+                : Sample entry of the pipeline JSON, updated
+  * str_output_dir : String
+                   : Output directory
+  """
+
+  llstr_links = []
+  for str_bam_key in [ c_STR_INSPECTOR_DNA_BAM, c_STR_INSPECTOR_RNA_BAM ]:
+    str_bam = dict_sample[ str_bam_key ]
+    str_bam_new = os.path.join( str_output_dir, os.path.basename( str_bam ) )
+    dict_sample[ str_bam_key ] = str_bam_new
+    llstr_links.append( [ str_bam, str_bam_new ] )
+    llstr_links.append( [ str_bam + c_STR_INDEX_EXT, str_bam_new + c_STR_INDEX_EXT ] )
+  return llstr_links
+
+
+def func_thread_map( func_call, lstr_paths ):
+  """
+  Map a file system call over paths on a thread pool, on NFS the time goes to waiting on metadata.
+
+  * func_call : Function
+              : Called with each path
+  * lstr_paths : List of strings
+               : Paths
+  """
+
+  pool_stat = multiprocessing.pool.ThreadPool( c_I_STAT_THREADS )
+  try:
+    l_results = pool_stat.map( func_call, lstr_paths )
+    pool_stat.close()
+  except:
+    pool_stat.terminate()
+    raise
+  finally:
+    pool_stat.join()
+  return l_results
+
+
+def func_link_missing( llstr_links ):
+  """
+  Make the links which are not there yet. The targets are checked on a thread pool first,
+  links to missing targets are not made. An existing link to another target is replaced,
+  anything else already at the link path is left alone and reported.
+  Returns [ number of links made, list of missing targets, list of paths which are in the way ].
+
+  * llstr_links : List of lists of strings
+                : Links as [ [ str_from_path, str_to_path ] ]
+  """
+
+  lf_exists = func_thread_map( os.path.exists, [ str_from_path for str_from_path, str_to_path in llstr_links ] )
+
+  i_made = 0
+  lstr_missing = []
+  lstr_in_the_way = []
+  for ( str_from_path, str_to_path ), f_exists in zip( llstr_links, lf_exists ):
+    if not f_exists:
+      lstr_missing.append( str_from_path )
+      continue
+    if os.path.islink( str_to_path ):
+      if os.readlink( str_to_path ) == str_from_path:
+        continue
+      os.remove( str_to_path )
+    elif os.path.lexists( str_to_path ):
+      lstr_in_the_way.append( str_to_path )
+      continue
+    os.symlink( str_from_path, str_to_path )
+    i_made = i_made + 1
+  return [ i_made, lstr_missing, lstr_in_the_way ]
+
+
+def func_register_links( llstr_links, dict_link_targets, lstr_duplicates ):
+  """
+  Keep the links whose path no other sample of the run links to a different target ( bams sharing a basename ).
+  Returns the links kept, the others are reported in lstr_duplicates and not made.
+  Only digests of the paths are kept for the links seen, full paths only for the duplicates.
+
+  * llstr_links : List of lists of strings
+                : Links of a sample as [ [ str_from_path, str_to_path ] ]
+  * dict_link_targets : Dictionary
+                      : { md5 of the link path : md5 of the target } of the links seen so far, updated
+  * lstr_duplicates : List of strings
+                    : Description of each duplicate, updated
+  """
+
+  llstr_kept = []
+  for str_from_path, str_to_path in llstr_links:
+    str_target_digest = hashlib.md5( str_from_path.encode( "utf-8" ) ).digest()
+    if dict_link_targets.setdefault( hashlib.md5( str_to_path.encode( "utf-8" ) ).digest(), str_target_digest ) != str_target_digest:
+      lstr_duplicates.append( str_to_path + " is already linked for another sample, not to " + str_from_path )
+      continue
+    llstr_kept.append( [ str_from_path, str_to_path ] )
+  return llstr_kept
+
 
 # Parse arguments
 prsr_arguments = argparse.ArgumentParser( prog = "convert_pipeline_json_for_inspector.py", description = "Converts the JSON file from the validation pipeline to a file useable for the galaxy inspector.", formatter_class = argparse.ArgumentDefaultsHelpFormatter )
 prsr_arguments.add_argument( dest = "output_dir", help = "Output dir." )
 prsr_arguments.add_argument( dest = "input_json", help = "Input JSON file." )
+prsr_arguments.add_argument( "--incremental", dest = "f_incremental", action = "store_true", default = False, help = "Update an existing output directory. Samples unchanged since its " + c_STR_INSPECTOR_JSON + " are skipped, links are only made where missing after checking their targets exist, and missing targets are listed at the end. Keeps a digest of every sample and link of the run in memory to find changes and bams sharing a basename, so memory grows with the number of samples ( about a kilobyte each )." )
 args_call = prsr_arguments.parse_args()
 
 # List of files to make links [ [ str_from_path, str_to_path ] ]
 llstr_files = []
 # Automatically made updated file
 str_output_json = os.path.basename( args_call.input_json )
-str_output_json = os.path.join( args_call.output_dir, "pipeline_inspector.json" )
-
-# If the output dir or the updated json file exist, fail.
-if os.path.exists( str_output_json ):
-  print( "The json file that would be made already exist. Please delete this file or rename it before running this script. File = " + str_output_json )
-  sys.exit( 101 )
-if os.path.exists( args_call.output_dir ):
-  print( "The output directory already exits. Please delete it to move forward. Dir = " + args_call.output_dir )
-  sys.exit( 102 )
-
-# Make output dir if it does not exist
-if not os.path.exists( args_call.output_dir ):
-  os.mkdir( args_call.output_dir )
-
-# Read in JSON file
-input_json = None
-with open( args_call.input_json, "r" ) as hndl_input_json:
-  input_json = json.loads( hndl_input_json.read() )
-if not input_json:
+str_output_json = os.path.join( args_call.output_dir, c_STR_INSPECTOR_JSON )
+
+# Update an earlier output, only touching new or changed samples
+if args_call.f_incremental:
+  dict_existing = {}
+  if os.path.exists( str_output_json ):
+    with open( str_output_json, "r" ) as hndl_existing_json:
+      for str_key, dict_sample in func_iter_json_mapping( hndl_existing_json ):
+        # Only digests of each key and entry are kept, enough to tell if it changed
+        dict_existing[ hashlib.md5( str_key.encode( "utf-8" ) ).digest() ] = hashlib.md5( func_dump_entry( str_key, dict_sample ) ).digest()
+  if not os.path.exists( args_call.output_dir ):
+    os.mkdir( args_call.output_dir )
+else:
+  # If the output dir or the updated json file exist, fail.
+  if os.path.exists( str_output_json ):
+    print( "The json file that would be made already exist. Please delete this file or rename it before running this script. File = " + str_output_json )
+    sys.exit( 101 )
+  if os.path.exists( args_call.output_dir ):
+    print( "The output directory already exits. Please delete it to move forward. Dir = " + args_call.output_dir )
+    sys.exit( 102 )
+
+  # Make output dir if it does not exist
+  if not os.path.exists( args_call.output_dir ):
+    os.mkdir( args_call.output_dir )
+
+# Stream the JSON file one sample at a time, updating paths, making links and writing the sample out.
+# The json is written through a temp file so a failure keeps an earlier one
+i_samples = 0
+i_changed = 0
+i_made = 0
+lstr_missing = []
+lstr_in_the_way = []
+lstr_duplicates = []
+dict_link_targets = {}
+llstr_unchanged = []
+try:
+  with open( args_call.input_json, "r" ) as hndl_input_json:
+    with open( str_output_json + ".tmp", "w" ) as hndl_output:
+      for str_key, dict_sample in func_iter_json_mapping( hndl_input_json ):
+        llstr_sample_links = func_convert_sample( dict_sample, args_call.output_dir )
+        str_entry = func_dump_entry( str_key, dict_sample )
+        hndl_output.write( ( ", \n" if i_samples else "{\n" ) + str_entry )
+        i_samples = i_samples + 1
+
+        if not args_call.f_incremental:
+          print dict_sample
+          for str_old_file, str_new_file in llstr_sample_links:
+            os.symlink( str_old_file, str_new_file )
+          continue
+
+        # Unchanged samples only need links which are gone, for example because their target was missing last time
+        llstr_sample_links = func_register_links( llstr_sample_links, dict_link_targets, lstr_duplicates )
+        if dict_existing.get( hashlib.md5( str_key.encode( "utf-8" ) ).digest() ) != hashlib.md5( str_entry ).digest():
+          llstr_files.extend( llstr_sample_links )
+          i_changed = i_changed + 1
+        else:
+          llstr_unchanged.extend( llstr_sample_links )
+        if len( llstr_files ) + len( llstr_unchanged ) >= c_I_LINK_BATCH:
+          lf_linked = func_thread_map( os.path.lexists, [ str_to_path for str_from_path, str_to_path in llstr_unchanged ] )
+          llstr_files.extend( [ lstr_link for lstr_link, f_linked in zip( llstr_unchanged, lf_linked ) if not f_linked ] )
+          i_batch_made, lstr_batch_missing, lstr_batch_in_the_way = func_link_missing( llstr_files )
+          i_made = i_made + i_batch_made
+          lstr_missing.extend( lstr_batch_missing )
+          lstr_in_the_way.extend( lstr_batch_in_the_way )
+          llstr_files = []
+          llstr_unchanged = []
+      hndl_output.write( "\n}" if i_samples else "" )
+except Exception as err_stream:
+  # Leave no partial output: the temp json goes, and a directory this run made is removed with its links.
+  # An incremental run keeps the earlier json and the links it made are reused next time
+  if os.path.exists( str_output_json + ".tmp" ):
+    os.remove( str_output_json + ".tmp" )
+  print( "Could not convert the JSON file after " + str( i_samples ) + " samples ( " + type( err_stream ).__name__ + ": " + str( err_stream ) + " )." )
+  if args_call.f_incremental:
+    print( "Links made before the error: " + str( i_made ) + ", " + str_output_json + " was not changed." )
+  else:
+    shutil.rmtree( args_call.output_dir, ignore_errors = True )
+    print( "Removed the partly made output directory " + args_call.output_dir + "." )
+  sys.exit( 104 )
+
+if not i_samples:
+  os.remove( str_output_json + ".tmp" )
   print( "JSON file was empty." )
   sys.exit( 103 )
+os.rename( str_output_json + ".tmp", str_output_json )
 
-# Update paths and store links
-for str_key, dict_sample in input_json.items():
-  print dict_sample
-  # In each sample update the sample name to the input dir
-  str_dna_bam = dict_sample[ c_STR_INSPECTOR_DNA_BAM ]
-  str_dna_bam_new = os.path.join( args_call.output_dir, os.path.basename( str_dna_bam ) )
-  str_rna_bam = dict_sample[ c_STR_INSPECTOR_RNA_BAM ]
-  str_rna_bam_new = os.path.join( args_call.output_dir, os.path.basename( str_rna_bam ) )
-
-  dict_sample[ c_STR_INSPECTOR_DNA_BAM ] = str_dna_bam_new 
-  dict_sample[ c_STR_INSPECTOR_RNA_BAM ] = str_rna_bam_new 
-
-  llstr_files.append( [ str_dna_bam, str_dna_bam_new ] )
-  llstr_files.append( [ str_rna_bam, str_rna_bam_new ] )
-
-# Make links
-for str_old_file, str_new_file in llstr_files: 
-  os.symlink( str_old_file, str_new_file ) 
-  os.symlink( str_old_file + ".bai", str_new_file + ".bai" )
-
-# Open handle and write json object to file
-with open( str_output_json, "w" ) as hndl_output:
-  hndl_output.write( json.dumps( input_json, sort_keys=True, indent=2 ) )
+if args_call.f_incremental:
+  lf_linked = func_thread_map( os.path.lexists, [ str_to_path for str_from_path, str_to_path in llstr_unchanged ] )
+  llstr_files.extend( [ lstr_link for lstr_link, f_linked in zip( llstr_unchanged, lf_linked ) if not f_linked ] )
+  i_batch_made, lstr_batch_missing, lstr_batch_in_the_way = func_link_missing( llstr_files )
+  i_made = i_made + i_batch_made
+  lstr_missing.extend( lstr_batch_missing )
+  lstr_in_the_way.extend( lstr_batch_in_the_way )
+  print( "Samples new or changed: " + str( i_changed ) + ", unchanged: " + str( i_samples - i_changed ) + ", links made: " + str( i_made ) )
+  if lstr_missing:
+    print( "Missing targets, not linked ( " + str( len( lstr_missing ) ) + " ):" )
+    for str_missing in lstr_missing:
+      print( "  " + str_missing )
+  if lstr_in_the_way:
+    print( "Not links, left alone ( " + str( len( lstr_in_the_way ) ) + " ):" )
+    for str_in_the_way in lstr_in_the_way:
+      print( "  " + str_in_the_way )
+  if lstr_duplicates:
+    print( "Bams sharing a basename, only the first is linked ( " + str( len( lstr_duplicates ) ) + " ):" )
+    for str_duplicate in lstr_duplicates:
+      print( "  " + str_duplicate )
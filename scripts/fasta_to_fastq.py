@@ -1,28 +1,434 @@
 #!/usr/bin/env python
 
 import argparse
-from Bio import SeqIO
+import gzip
+import heapq
+import itertools
+import multiprocessing
 import os
+import Queue
+import random
+import time
 
-iEntries = 5000
-iCurEntries = 0
-sOut = ""
+# Perfect quality score written for every base
+chrQuality = "~"
+
+# Bytes read from the fasta file at a time
+iReadBlock = 1 << 22
+
+# Bytes written to the fastq file at a time
+iWriteBuffer = 1 << 22
+
+# Quality strings up to this length are cached by length ( longer ones are contigs, made once )
+iMaxCachedQuality = 100000
+
+# Phred scores written as Sanger ( Phred+33 ), anything over the top of the scale is capped
+iPhredOffset = 33
+iMaxPhred = 93
+strPhredTable = "".join( [ chr( iPhredOffset + min( iPhred, iMaxPhred ) ) for iPhred in xrange( 256 ) ] )
+
+# Ways of balancing records across --shards
+strShardRecords = "records"
+strShardBases = "bases"
+lsShardChoices = [ strShardRecords, strShardBases ]
+
+# Buffers held per gzip shard worker before the reader waits on it
+iShardQueueSize = 8
+
+# Record sizes and line width of the synthetic fasta used by --benchmark
+iSyntheticMinLength = 100
+iSyntheticMaxLength = 10000
+iSyntheticWidth = 60
+
+
+def funcParseRecord( strRecord ):
+  """
+  Return [ id, sequence ] from the raw text of a record ( everything after the > ).
+  As in Biopython the id is the first word of the title and spaces are removed from the sequence.
+
+  * strRecord : String
+              : Raw text of one record without the leading >
+  """
+
+  iTitleEnd = strRecord.find( "\n" )
+  if iTitleEnd < 0:
+    strTitle, strBody = strRecord, ""
+  else:
+    strTitle, strBody = strRecord[ :iTitleEnd ], strRecord[ iTitleEnd: ]
+  lsTitle = strTitle.split( None, 1 )
+  return [ lsTitle[ 0 ] if lsTitle else "", strBody.translate( None, "\r\n " ) ]
+
+
+def funcParseQualRecord( strRecord ):
+  """
+  Return [ id, quality string ] from the raw text of a qual record ( everything after the > ).
+  The space delimited Phred scores are encoded all at once through a byte translate table.
+
+  * strRecord : String
+              : Raw text of one qual record without the leading >
+  """
+
+  iTitleEnd = strRecord.find( "\n" )
+  if iTitleEnd < 0:
+    strTitle, strBody = strRecord, ""
+  else:
+    strTitle, strBody = strRecord[ :iTitleEnd ], strRecord[ iTitleEnd: ]
+  lsTitle = strTitle.split( None, 1 )
+  try:
+    strQual = str( bytearray( map( int, strBody.split() ) ) ).translate( strPhredTable )
+  except ValueError:
+    raise ValueError( "Qual record has scores which are not between 0 and 255. Record = " + strTitle )
+  return [ lsTitle[ 0 ] if lsTitle else "", strQual ]
+
+
+def funcIterFasta( hndlFasta, funcParse = funcParseRecord ):
+  """
+  Yield [ id, sequence ] for each record, reading the file in large blocks.
+  Blocks are cut on "\n>" so long contigs are joined once instead of line by line.
+  Text before the first record is ignored.
+
+  * hndlFasta : File handle
+              : Handle to the fasta file opened in binary mode
+  * funcParse : Function
+              : Parses the raw text of a record, funcParseQualRecord reads qual files
+  """
+
+  lsPieces = []
+  fInRecord = False
+  # The file start counts as a line start so a leading > is found
+  fLineStart = True
+  while True:
+    strBlock = hndlFasta.read( iReadBlock )
+    if not strBlock:
+      break
+    # A record start split across blocks ends one block with \n and starts the next with >
+    lsParts = ( ( "\n" + strBlock ) if fLineStart else strBlock ).split( "\n>" )
+    fLineStart = strBlock[ -1 ] == "\n"
+    if fInRecord:
+      lsPieces.append( lsParts[ 0 ] )
+    for strPart in lsParts[ 1: ]:
+      if fInRecord:
+        yield funcParse( "".join( lsPieces ) )
+      lsPieces = [ strPart ]
+      fInRecord = True
+  if fInRecord:
+    yield funcParse( "".join( lsPieces ) )
+
+
+def funcIterFastaQual( hndlFasta, hndlQual ):
+  """
+  Yield [ fastq record text, number of bases ] reading a fasta and its qual file in lockstep.
+  Only one record of each file is held at a time. Ids and lengths must agree.
+
+  * hndlFasta : File handle
+              : Handle to the fasta file opened in binary mode
+  * hndlQual : File handle
+             : Handle to the qual file opened in binary mode
+  """
+
+  for lSeq, lQual in itertools.izip_longest( funcIterFasta( hndlFasta ), funcIterFasta( hndlQual, funcParseQualRecord ) ):
+    if lSeq is None or lQual is None:
+      raise ValueError( "Fasta and qual files have a different number of records. Last record = " + ( lSeq or lQual )[ 0 ] )
+    strId, strSeq = lSeq
+    strQualId, strQual = lQual
+    if not strId == strQualId:
+      raise ValueError( "Fasta and qual records are out of step. Fasta id = " + strId + " Qual id = " + strQualId )
+    if not len( strSeq ) == len( strQual ):
+      raise ValueError( "Sequence and quality lengths differ. Record = " + strId )
+    yield [ os.linesep.join( [ "@" + strId, strSeq, "+", strQual ] ) + os.linesep, len( strSeq ) ]
+
+
+def funcIterFastq( hndlFasta, hndlQual = None ):
+  """
+  Yield [ fastq record text, number of bases ] for each fasta record.
+  Qualities come from the qual file if given, otherwise every base gets a perfect quality.
+
+  * hndlFasta : File handle
+              : Handle to the fasta file opened in binary mode
+  * hndlQual : File handle
+             : Optional handle to the matching qual file opened in binary mode
+  """
+
+  if hndlQual:
+    for lRecord in funcIterFastaQual( hndlFasta, hndlQual ):
+      yield lRecord
+    return
+
+  dictQualities = {}
+  for strId, strSeq in funcIterFasta( hndlFasta ):
+    iLength = len( strSeq )
+    strQual = dictQualities.get( iLength )
+    if strQual is None:
+      strQual = chrQuality * iLength
+      if iLength <= iMaxCachedQuality:
+        dictQualities[ iLength ] = strQual
+    yield [ os.linesep.join( [ "@" + strId, strSeq, "+", strQual ] ) + os.linesep, iLength ]
+
+
+def funcOpenQual( strQualFile ):
+  """
+  Open the qual file if one is given, None otherwise.
+
+  * strQualFile : String
+                : Path to the qual file or None
+  """
+
+  return open( strQualFile, "rb" ) if strQualFile else None
 
-arp = argparse.ArgumentParser( prog = "FastaToFastQ.py", description = "Converts a Fasta to a Fastq file by indicating all quality scores are perfect." )
-arp.add_argument( "strFileToConvert", help = "File to convert" )
-arp.add_argument( "strFileToWrite", help = "File to write" )
-args = arp.parse_args()
 
-with open(args.strFileToWrite, "w") as hndlWrite:
-  with open(args.strFileToConvert,"rU") as hndlFastaFile:
-    for record in SeqIO.parse(hndlFastaFile, "fasta"):
-      sOut = sOut+os.linesep.join(["@"+record.id, str( record.seq ), "+", "".join(["~"] * len( str( record.seq ))) ]) + os.linesep
-      iCurEntries = iCurEntries + 1
-      if iCurEntries >= iEntries:
-        hndlWrite.write(sOut)
-        iCurEntries = 0
-        sOut = ""
-    hndlWrite.write(sOut)
+def funcConvert( strFileToConvert, strFileToWrite, strQualFile = None ):
+  """
+  Convert a fasta file to a fastq file, streaming in constant memory ( bounded by the largest record ).
+  Qualities come from the qual file if given, otherwise they are perfect.
+  Returns the number of records written.
 
+  * strFileToConvert : String
+                     : Path to the fasta file
+  * strFileToWrite : String
+                   : Path to the fastq file to write
+  * strQualFile : String
+                : Optional path to the matching qual file
+  """
 
+  iRecords = 0
+  hndlQual = funcOpenQual( strQualFile )
+  try:
+    with open( strFileToWrite, "wb", iWriteBuffer ) as hndlWrite:
+      with open( strFileToConvert, "rb" ) as hndlFastaFile:
+        for strRecord, iLength in funcIterFastq( hndlFastaFile, hndlQual ):
+          hndlWrite.write( strRecord )
+          iRecords = iRecords + 1
+  finally:
+    if hndlQual:
+      hndlQual.close()
+  return iRecords
+
+
+def funcShardPaths( strFileToWrite, iShards, fGzip ):
+  """
+  Paths of the shards, <base>_<i><ext> counting from 1, with .gz added when compressing.
+
+  * strFileToWrite : String
+                   : Path given for the fastq file
+  * iShards : Integer
+            : Number of shards
+  * fGzip : Boolean
+          : True if the shards are gzipped
+  """
+
+  strBase, strExt = os.path.splitext( strFileToWrite )
+  strGz = ".gz" if fGzip else ""
+  return [ strBase + "_" + str( iShard ) + strExt + strGz for iShard in xrange( 1, iShards + 1 ) ]
+
+
+def funcGzipShard( strPath, queueShard ):
+  """
+  Worker compressing one shard. Writes the buffers it is sent until it gets None.
+
+  * strPath : String
+            : Path of the gzipped shard
+  * queueShard : Queue
+               : Buffers of fastq text for this shard
+  """
+
+  with gzip.open( strPath, "wb" ) as hndlShard:
+    for strBuffer in iter( queueShard.get, None ):
+      hndlShard.write( strBuffer )
+
+
+def funcConvertSharded( strFileToConvert, strFileToWrite, iShards, strShardBy, fGzip, strQualFile = None ):
+  """
+  Convert a fasta file to N fastq shards in one pass.
+  Records go round-robin, or to the shard with the fewest bases so far.
+  When gzipping each shard is compressed by its own worker process.
+  Returns the number of records written to each shard.
+
+  * strFileToConvert : String
+                     : Path to the fasta file
+  * strFileToWrite : String
+                   : Path given for the fastq file, shards are named from it
+  * iShards : Integer
+            : Number of shards
+  * strShardBy : String
+               : One of lsShardChoices
+  * fGzip : Boolean
+          : True to gzip each shard in its own worker
+  * strQualFile : String
+                : Optional path to the matching qual file
+  """
+
+  lsPaths = funcShardPaths( strFileToWrite, iShards, fGzip )
+  liRecords = [ 0 ] * iShards
+  # Heap of [ bases, shard ] so the lightest shard is on top
+  liBases = [ [ 0, iShard ] for iShard in xrange( iShards ) ]
+
+  # Buffers of text per shard, handed to a file or a gzip worker when full
+  llsBuffers = [ [] for iShard in xrange( iShards ) ]
+  liBuffered = [ 0 ] * iShards
+  lprocWorkers = []
+  lqueueShards = []
+  lhndlShards = []
+  if fGzip:
+    lqueueShards = [ multiprocessing.Queue( iShardQueueSize ) for iShard in xrange( iShards ) ]
+    lprocWorkers = [ multiprocessing.Process( target = funcGzipShard, args = ( strPath, queueShard ) ) for strPath, queueShard in zip( lsPaths, lqueueShards ) ]
+    for procWorker in lprocWorkers:
+      procWorker.start()
+  else:
+    lhndlShards = [ open( strPath, "wb", iWriteBuffer ) for strPath in lsPaths ]
+
+  def funcFlush( iShard ):
+    strBuffer = "".join( llsBuffers[ iShard ] )
+    llsBuffers[ iShard ] = []
+    liBuffered[ iShard ] = 0
+    if not fGzip:
+      lhndlShards[ iShard ].write( strBuffer )
+      return
+    # Do not wait forever on a worker which died
+    while True:
+      try:
+        lqueueShards[ iShard ].put( strBuffer, timeout = 1 )
+        return
+      except Queue.Full:
+        if not lprocWorkers[ iShard ].is_alive():
+          raise IOError( "Gzip worker stopped early for shard " + lsPaths[ iShard ] )
+
+  hndlQual = funcOpenQual( strQualFile )
+  try:
+    with open( strFileToConvert, "rb" ) as hndlFastaFile:
+      iRecord = 0
+      for strRecord, iLength in funcIterFastq( hndlFastaFile, hndlQual ):
+        if strShardBy == strShardBases:
+          lShard = heapq.heappop( liBases )
+          iShard = lShard[ 1 ]
+          lShard[ 0 ] = lShard[ 0 ] + iLength
+          heapq.heappush( liBases, lShard )
+        else:
+          iShard = iRecord % iShards
+        iRecord = iRecord + 1
+        liRecords[ iShard ] = liRecords[ iShard ] + 1
+        llsBuffers[ iShard ].append( strRecord )
+        liBuffered[ iShard ] = liBuffered[ iShard ] + len( strRecord )
+        if liBuffered[ iShard ] >= iWriteBuffer:
+          funcFlush( iShard )
+    for iShard in xrange( iShards ):
+      funcFlush( iShard )
+  finally:
+    if hndlQual:
+      hndlQual.close()
+    for hndlShard in lhndlShards:
+      hndlShard.close()
+    for queueShard, procWorker in zip( lqueueShards, lprocWorkers ):
+      if procWorker.is_alive():
+        queueShard.put( None )
+    for procWorker in lprocWorkers:
+      procWorker.join()
+  for strPath, procWorker in zip( lsPaths, lprocWorkers ):
+    if procWorker.exitcode:
+      raise IOError( "Gzip worker failed for shard " + strPath )
+  return liRecords
+
+
+def funcConvertSeqIO( strFileToConvert, strFileToWrite ):
+  """
+  The original Biopython conversion, kept as the baseline for --benchmark.
+  Returns the number of records written.
+
+  * strFileToConvert : String
+                     : Path to the fasta file
+  * strFileToWrite : String
+                   : Path to the fastq file to write
+  """
+
+  from Bio import SeqIO
+
+  iEntries = 5000
+  iCurEntries = 0
+  iRecords = 0
+  sOut = ""
+  with open(strFileToWrite, "w") as hndlWrite:
+    with open(strFileToConvert,"rU") as hndlFastaFile:
+      for record in SeqIO.parse(hndlFastaFile, "fasta"):
+        sOut = sOut+os.linesep.join(["@"+record.id, str( record.seq ), "+", "".join(["~"] * len( str( record.seq ))) ]) + os.linesep
+        iCurEntries = iCurEntries + 1
+        iRecords = iRecords + 1
+        if iCurEntries >= iEntries:
+          hndlWrite.write(sOut)
+          iCurEntries = 0
+          sOut = ""
+      hndlWrite.write(sOut)
+  return iRecords
+
+
+def funcMakeSyntheticFasta( strFile, dGigabytes ):
+  """
+  Write a synthetic fasta file of about the given size with records of random length.
+
+  * strFile : String
+            : Path to write the fasta file to
+  * dGigabytes : Float
+               : Size of the file in GB
+  """
+
+  iTarget = int( dGigabytes * ( 1 << 30 ) )
+  # Reuse slices of one random sequence, generating every base would take longer than the benchmark
+  strBases = "".join( [ random.choice( "ACGT" ) for iBase in xrange( 2 * iSyntheticMaxLength ) ] )
+  iWritten = 0
+  iRecord = 0
+  with open( strFile, "wb", iWriteBuffer ) as hndlFasta:
+    while iWritten < iTarget:
+      iLength = random.randint( iSyntheticMinLength, iSyntheticMaxLength )
+      iStart = random.randint( 0, iSyntheticMaxLength )
+      strSeq = strBases[ iStart : iStart + iLength ]
+      strRecord = ">synthetic_" + str( iRecord ) + " length=" + str( iLength ) + "\n" + "\n".join( [ strSeq[ iLine : iLine + iSyntheticWidth ] for iLine in xrange( 0, iLength, iSyntheticWidth ) ] ) + "\n"
+      hndlFasta.write( strRecord )
+      iWritten = iWritten + len( strRecord )
+      iRecord = iRecord + 1
+
+
+def funcBenchmark( strFileToConvert, strFileToWrite, dGigabytes ):
+  """
+  Time the streaming conversion against the original SeqIO.parse path and print the throughput of each.
+  A synthetic fasta of the given size is made first if the input file does not exist.
+
+  * strFileToConvert : String
+                     : Fasta file to time with, made if missing
+  * strFileToWrite : String
+                   : Fastq file written ( over written ) by each run
+  * dGigabytes : Float
+               : Size of the synthetic fasta in GB
+  """
+
+  if not os.path.exists( strFileToConvert ):
+    print "Making synthetic fasta of " + str( dGigabytes ) + " GB: " + strFileToConvert
+    funcMakeSyntheticFasta( strFileToConvert, dGigabytes )
+  dMegabytes = os.path.getsize( strFileToConvert ) / float( 1 << 20 )
+
+  for strEngine, funcEngine in [ [ "streaming", funcConvert ], [ "SeqIO.parse", funcConvertSeqIO ] ]:
+    dStart = time.time()
+    try:
+      iRecords = funcEngine( strFileToConvert, strFileToWrite )
+    except ImportError:
+      print "Engine " + strEngine + ": Biopython is not installed"
+      continue
+    dSeconds = max( time.time() - dStart, 1e-9 )
+    print "Engine %s: %i records, %.1f MB in %.2f seconds, %.1f MB/sec, %.0f records/sec" % ( strEngine, iRecords, dMegabytes, dSeconds, dMegabytes / dSeconds, iRecords / dSeconds )
+
+
+arp = argparse.ArgumentParser( prog = "FastaToFastQ.py", description = "Converts a Fasta to a Fastq file by indicating all quality scores are perfect, or with the scores of a matching qual file." )
+arp.add_argument( "strFileToConvert", help = "File to convert" )
+arp.add_argument( "strFileToWrite", help = "File to write" )
+arp.add_argument( "--benchmark", metavar = "Size_GB", dest = "dBenchmark", type = float, default = None, help = "Time this conversion against the SeqIO.parse version instead of converting. If the file to convert does not exist a synthetic fasta of this many GB ( eg. 10 ) is made there first." )
+arp.add_argument( "--shards", metavar = "Shards", dest = "iShards", type = int, default = 1, help = "Write this many fastq files in one pass ( <file_to_write base>_<i><ext> ) to feed parallel aligners." )
+arp.add_argument( "--shard_by", dest = "strShardBy", choices = lsShardChoices, default = strShardRecords, help = "Balance shards by record count ( round-robin ) or by number of bases." )
+arp.add_argument( "--gzip", dest = "fGzip", action = "store_true", default = False, help = "Gzip each shard, each in its own worker process." )
+arp.add_argument( "--qual", metavar = "Qual_File", dest = "strQualFile", default = None, help = "Qual file ( eg. 454 / Ion ) with the Phred scores of the fasta, in the same record order. Written as Sanger Phred+33." )
+args = arp.parse_args()
 
+if args.dBenchmark:
+  funcBenchmark( args.strFileToConvert, args.strFileToWrite, args.dBenchmark )
+elif args.iShards > 1 or args.fGzip:
+  liRecords = funcConvertSharded( args.strFileToConvert, args.strFileToWrite, max( 1, args.iShards ), args.strShardBy, args.fGzip, args.strQualFile )
+  for strPath, iRecords in zip( funcShardPaths( args.strFileToWrite, len( liRecords ), args.fGzip ), liRecords ):
+    print strPath + ": " + str( iRecords ) + " records"
+else:
+  funcConvert( args.strFileToConvert, args.strFileToWrite, args.strQualFile )
@@ -9,45 +9,559 @@ __email__ = "ttickle@broadinstitute.org"
 __status__ = "Development"
 
 import argparse
+import binascii
+import glob
+import heapq
+import multiprocessing
+import multiprocessing.managers
 import os
+import Queue
+import shlex
+import signal
+import socket
+import subprocess
+import time
 
 str_placeholder = "###"
 
+# Job array mode, the index file extension and the LSF variable holding the array index
+str_index_extension = ".index"
+str_lsf_job_index = "LSB_JOBINDEX"
+
+# Local mode, marker written next to <sample>.out when a sample's command finished without error
+str_done_extension = ".done"
+
+# Cost column delimiter in the sample file, and the files written per sample which are not its inputs
+str_cost_delimiter = "\t"
+ls_str_log_extensions = [ ".out", ".err", str_done_extension ]
+# Characters which may follow the sample name in the names of its files
+ls_str_sample_delimiters = [ "_", ".", "-" ]
+
+# Work queue mode, seconds the coordinator stays up after the last task so workers see the end of the queue
+i_queue_linger = 10
+# Seconds the coordinator waits on results before checking leases
+i_queue_poll = 1
+
+
+class TaskManager( multiprocessing.managers.BaseManager ):
+  """
+  Serves the task and result queues of the work queue mode to workers on any host.
+  """
+
+  pass
+
+
+def func_parse_address( str_address ):
+  """
+  Split host:port into the ( host, port ) tuple the managers take. An empty host means all interfaces.
+
+  * str_address : String
+                : host:port or :port
+  """
+
+  str_host, str_port = str_address.rsplit( ":", 1 )
+  return ( str_host, int( str_port ) )
+
+
+def func_write_array( ls_str_samples, str_command_template, str_out_file, str_job_name, i_array_limit, i_array_max, str_bsub_options ):
+  """
+  Write LSF job array submissions for all samples instead of a bsub per sample.
+  Writes <out>.index ( line N is sample N ), <out>_task.sh which looks up its sample from the index at run time
+  and runs the template with the placeholder replaced, and <out>0.sh with the bsubs. More samples than i_array_max
+  are split into several arrays of at most i_array_max tasks sharing the index file. LSF caps the index values as
+  well as the array size, so each array is indexed from 1 and passes the task script its offset in the index file.
+  With a limit, each array waits for the one before it to end, so no more than i_array_limit tasks run at once in total.
+
+  * ls_str_samples : List of strings
+                   : Samples, in array index order
+  * str_command_template : String
+                         : Command with the placeholder for the sample
+  * str_out_file : String
+                 : Base name of the files written
+  * str_job_name : String
+                 : Name of the job array
+  * i_array_limit : Integer
+                  : Most tasks running at once over all the arrays, 0 for no limit
+  * i_array_max : Integer
+                : Most tasks in one array ( MAX_JOB_ARRAY_SIZE of LSF )
+  * str_bsub_options : String
+                     : Queue, memory and email options for bsub
+  """
+
+  str_index_file = os.path.abspath( str_out_file + str_index_extension )
+  str_task_file = os.path.abspath( str_out_file + "_task.sh" )
+
+  with open( str_index_file, "w" ) as hndl_index:
+    for str_sample in ls_str_samples:
+      hndl_index.write( str_sample + os.linesep )
+
+  # The task wrapper writes <sample>.out / <sample>.err as the per sample bsub commands do
+  with open( str_task_file, "w" ) as hndl_task:
+    hndl_task.write( "#!/bin/sh" + os.linesep )
+    hndl_task.write( "str_sample=$( sed -n \"$(( ${" + str_lsf_job_index + "} + ${1:-0} ))p\" " + str_index_file + " )" + os.linesep )
+    hndl_task.write( "exec > \"${str_sample}.out\" 2> \"${str_sample}.err\"" + os.linesep )
+    hndl_task.write( str_command_template.replace( str_placeholder, "${str_sample}" ) + os.linesep )
+  os.chmod( str_task_file, 0755 )
+
+  i_array_max = max( 1, i_array_max )
+  with open( str_out_file + "0.sh", "w" ) as hndl_out:
+    str_previous_name = None
+    for i_offset in xrange( 0, len( ls_str_samples ), i_array_max ):
+      # Arrays after the first are named name_2, name_3, ... so their logs do not collide
+      str_array_name = str_job_name if i_offset == 0 else str_job_name + "_" + str( i_offset // i_array_max + 1 )
+      str_array = str_array_name + "[1-" + str( min( i_array_max, len( ls_str_samples ) - i_offset ) ) + "]"
+      if i_array_limit > 0:
+        str_array = str_array + "%" + str( i_array_limit )
+      # The %K throttle is per array, chaining the arrays keeps it a total
+      str_wait = "" if str_previous_name is None or i_array_limit <= 0 else "-w \"ended(" + str_previous_name + ")\" "
+      hndl_out.write( "bsub " + str_bsub_options + str_wait + "-J \"" + str_array + "\" -e " + str_array_name + ".%I.lsf.err -o " + str_array_name + ".%I.lsf.out " + str_task_file + " " + str( i_offset ) + os.linesep )
+      str_previous_name = str_array_name
+
+
+def func_local_workers( str_memory ):
+  """
+  Number of commands to run at once locally, as many as fit in the host memory at the requested memory each, at most one per core.
+
+  * str_memory : String
+               : Memory in GB needed per command
+  """
+
+  i_cores = multiprocessing.cpu_count()
+  try:
+    f_host_gb = os.sysconf( "SC_PAGE_SIZE" ) * os.sysconf( "SC_PHYS_PAGES" ) / float( 1024 ** 3 )
+  except ( ValueError, OSError, AttributeError ):
+    return i_cores
+  return max( 1, min( i_cores, int( f_host_gb // max( float( str_memory ), 0.001 ) ) ) )
+
+
+def func_run_local( str_sample, str_command, func_heartbeat = None, i_heartbeat = 0 ):
+  """
+  Run one sample's command locally writing <sample>.out and <sample>.err, and the done marker if it succeeds.
+  Returns ( sample, exit code ).
+
+  * str_sample : String
+               : Sample name
+  * str_command : String
+                : Command with the placeholder already replaced
+  * func_heartbeat : Function
+                   : Called every i_heartbeat seconds while the command runs, and once when it ends, None for no heartbeat.
+                   : Returns False if the task was given up on, the command is then killed and no done marker is written.
+  * i_heartbeat : Integer
+                : Seconds between heartbeats
+  """
+
+  with open( str_sample + ".out", "w" ) as hndl_out:
+    with open( str_sample + ".err", "w" ) as hndl_err:
+      if func_heartbeat is None:
+        prc_command = subprocess.Popen( str_command, shell = True, stdout = hndl_out, stderr = hndl_err )
+        i_return = prc_command.wait()
+      else:
+        # Own process group so killing the command also kills what the shell started
+        prc_command = subprocess.Popen( str_command, shell = True, stdout = hndl_out, stderr = hndl_err, preexec_fn = os.setsid )
+        f_current = True
+        f_last_beat = time.time()
+        while prc_command.poll() is None:
+          time.sleep( min( 1, i_heartbeat ) )
+          if time.time() - f_last_beat >= i_heartbeat:
+            f_current = func_heartbeat()
+            f_last_beat = time.time()
+            if not f_current:
+              try:
+                os.killpg( prc_command.pid, signal.SIGTERM )
+              except OSError:
+                pass
+              prc_command.wait()
+        i_return = prc_command.returncode
+        if i_return == 0 and f_current and not func_heartbeat():
+          i_return = -signal.SIGTERM
+  if i_return == 0:
+    open( str_sample + str_done_extension, "w" ).close()
+  return ( str_sample, i_return )
+
+
+def func_star_run_local( lstr_task ):
+  """
+  func_run_local for Pool.imap_unordered, which passes one argument.
+
+  * lstr_task : List of strings
+              : [ sample, command ]
+  """
+
+  return func_run_local( *lstr_task )
+
+
+def func_run_all_local( ls_str_samples, str_command_template, i_workers ):
+  """
+  Run the command for every sample on this host in a pool of workers instead of submitting to LSF.
+  Samples with a done marker from an earlier run are skipped so a rerun resumes. Returns the number of failed samples.
+
+  * ls_str_samples : List of strings
+                   : Samples
+  * str_command_template : String
+                         : Command with the placeholder for the sample
+  * i_workers : Integer
+              : Commands run at once
+  """
+
+  llstr_tasks = [ [ str_sample, str_command_template.replace( str_placeholder, str_sample ) ] for str_sample in ls_str_samples if not os.path.exists( str_sample + str_done_extension ) ]
+  print "Running " + str( len( llstr_tasks ) ) + " of " + str( len( ls_str_samples ) ) + " samples with " + str( i_workers ) + " workers, the others are already done."
+
+  i_failed = 0
+  if llstr_tasks:
+    pool_workers = multiprocessing.Pool( i_workers )
+    try:
+      for str_sample, i_return in pool_workers.imap_unordered( func_star_run_local, llstr_tasks ):
+        if i_return != 0:
+          i_failed = i_failed + 1
+          print "Failed ( exit code " + str( i_return ) + " ): " + str_sample + ", see " + str_sample + ".err"
+      pool_workers.close()
+    except:
+      pool_workers.terminate()
+      raise
+    finally:
+      pool_workers.join()
+  print "Finished " + str( len( llstr_tasks ) - i_failed ) + " samples, " + str( i_failed ) + " failed."
+  return i_failed
+
+
+def func_is_sample_file( str_sample, str_file ):
+  """
+  True if a file belongs to the sample: a directory or file in its path is the sample name or the sample name
+  followed by _ . or - ( sample_R1.fastq.gz, sample.bam, sample/reads.fq, not sample10.bam or the shared reference ).
+
+  * str_sample : String
+               : Sample name or path
+  * str_file : String
+             : Path of the file
+  """
+
+  str_name = os.path.basename( os.path.normpath( str_sample ) )
+  for str_part in os.path.abspath( str_file ).split( os.sep ):
+    if str_part == str_name or any( [ str_part.startswith( str_name + str_delimiter ) for str_delimiter in ls_str_sample_delimiters ] ):
+      return True
+  return False
+
+
+def func_sample_size( str_sample, str_command ):
+  """
+  Estimated cost of a sample, the total size in bytes of the sample's files its command names ( arguments or
+  --opt=values which are files of the sample, func_is_sample_file, so not a reference or script all samples share ).
+  If the command names none, the files named after the sample: the sample itself or the sample followed by _ . or -.
+  Logs of earlier runs are not counted.
+
+  * str_sample : String
+               : Sample name or path
+  * str_command : String
+                : Command with the placeholder already replaced
+  """
+
+  set_files = set()
+  try:
+    ls_str_words = shlex.split( str_command )
+  except ValueError:
+    ls_str_words = str_command.split()
+  for str_word in ls_str_words:
+    for str_path in [ str_word, str_word.split( "=", 1 )[ -1 ] ]:
+      if os.path.isfile( str_path ) and func_is_sample_file( str_sample, str_path ):
+        set_files.add( os.path.abspath( str_path ) )
+  if not set_files:
+    for str_pattern in [ str_sample ] + [ str_sample + str_delimiter + "*" for str_delimiter in ls_str_sample_delimiters ]:
+      set_files.update( [ os.path.abspath( str_file ) for str_file in glob.glob( str_pattern ) if os.path.isfile( str_file ) ] )
+
+  i_size = 0
+  for str_file in set_files:
+    if os.path.splitext( str_file )[ 1 ] not in ls_str_log_extensions:
+      i_size = i_size + os.path.getsize( str_file )
+  return i_size
+
+
+def func_balance_groups( ls_str_commands, lf_costs, i_groups ):
+  """
+  Pack commands into groups so each group has about the same total cost.
+  Greedy, most costly command first to the group with the least cost.
+  Returns a list of lists of commands, commands in a group keep the sample file order.
+
+  * ls_str_commands : List of strings
+                    : Commands
+  * lf_costs : List of floats
+             : Estimated cost of each command
+  * i_groups : Integer
+             : Number of groups
+  """
+
+  li_groups = [ 0 ] * len( ls_str_commands )
+  # Heap of [ cost, group ] so the lightest group is on top
+  llf_heap = [ [ 0, i_group ] for i_group in xrange( i_groups ) ]
+  for i_command in sorted( xrange( len( ls_str_commands ) ), key = lf_costs.__getitem__, reverse = True ):
+    lf_group = heapq.heappop( llf_heap )
+    lf_group[ 0 ] += lf_costs[ i_command ]
+    li_groups[ i_command ] = lf_group[ 1 ]
+    heapq.heappush( llf_heap, lf_group )
+  lls_str_groups = [ [] for i_group in xrange( i_groups ) ]
+  for i_command in xrange( len( ls_str_commands ) ):
+    lls_str_groups[ li_groups[ i_command ] ].append( ls_str_commands[ i_command ] )
+  return lls_str_groups
+
+
+def func_serve_queue( ls_str_samples, str_command_template, str_address, str_authkey, i_retries, i_lease ):
+  """
+  Coordinator of the work queue mode. Serves the commands of the samples not done yet to workers ( func_work_queue )
+  and collects their exit codes. A worker holds a lease on the task it runs, renewed by heartbeats; a lease not renewed
+  for i_lease seconds ( the worker or its host died ) counts as a failure. Failed samples are queued again up to i_retries times.
+  Returns the number of samples which still failed.
+
+  * ls_str_samples : List of strings
+                   : Samples
+  * str_command_template : String
+                         : Command with the placeholder for the sample
+  * str_address : String
+                : host:port to listen on
+  * str_authkey : String
+                : Shared key the workers must give
+  * i_retries : Integer
+              : Times a failed sample is tried again
+  * i_lease : Integer
+            : Seconds without a heartbeat before a running task is given up
+  """
+
+  queue_tasks = Queue.Queue()
+  queue_results = Queue.Queue()
+  dict_current = {}
+  TaskManager.register( "get_tasks", callable = lambda: queue_tasks )
+  TaskManager.register( "get_results", callable = lambda: queue_results )
+  TaskManager.register( "get_current", callable = lambda: dict_current, proxytype = multiprocessing.managers.DictProxy )
+  mngr_queue = TaskManager( address = func_parse_address( str_address ), authkey = str_authkey )
+  mngr_queue.start()
+  try:
+    proxy_tasks = mngr_queue.get_tasks()
+    proxy_results = mngr_queue.get_results()
+    # Attempt of each pending sample, tasks are [ sample, attempt, command, heartbeat seconds ]
+    # Workers see the current attempts too, and drop or stop tasks of attempts which are not current any more
+    proxy_current = mngr_queue.get_current()
+    dict_tries = {}
+    for str_sample in ls_str_samples:
+      if not os.path.exists( str_sample + str_done_extension ):
+        dict_tries[ str_sample ] = 0
+        proxy_current[ str_sample ] = 0
+        proxy_tasks.put( [ str_sample, 0, str_command_template.replace( str_placeholder, str_sample ), max( 1, i_lease // 4 ) ] )
+    print "Serving " + str( len( dict_tries ) ) + " of " + str( len( ls_str_samples ) ) + " samples on " + str_address + ", the others are already done."
+
+    i_samples = len( dict_tries )
+    i_failed = 0
+    # { sample : [ attempt, host, time of the last heartbeat ] } of the running tasks
+    dict_leases = {}
+    while dict_tries:
+      # Messages are [ start / alive / done, sample, attempt, exit code, host ]
+      try:
+        str_kind, str_sample, i_attempt, i_return, str_host = proxy_results.get( True, i_queue_poll )
+      except Queue.Empty:
+        str_kind = None
+
+      # [ sample, why ] of the attempts which failed
+      llstr_failures = []
+      # Only the current attempt of a sample counts, one given up on stops itself at its next heartbeat
+      if str_kind and str_sample in dict_tries and i_attempt == dict_tries[ str_sample ]:
+        if str_kind != "done":
+          dict_leases[ str_sample ] = [ i_attempt, str_host, time.time() ]
+        elif i_return == 0:
+          print "Done: " + str_sample + " on " + str_host
+          del dict_tries[ str_sample ]
+          del proxy_current[ str_sample ]
+          dict_leases.pop( str_sample, None )
+        else:
+          dict_leases.pop( str_sample, None )
+          llstr_failures.append( [ str_sample, "exit code " + str( i_return ) + " on " + str_host ] )
+
+      f_now = time.time()
+      for str_sample in sorted( dict_leases ):
+        i_attempt, str_host, f_seen = dict_leases[ str_sample ]
+        if f_now - f_seen > i_lease:
+          del dict_leases[ str_sample ]
+          llstr_failures.append( [ str_sample, "no heartbeat from " + str_host + " for " + str( i_lease ) + " seconds" ] )
+
+      for str_sample, str_why in llstr_failures:
+        if dict_tries[ str_sample ] < i_retries:
+          dict_tries[ str_sample ] = dict_tries[ str_sample ] + 1
+          proxy_current[ str_sample ] = dict_tries[ str_sample ]
+          print "Retrying ( " + str_why + " ): " + str_sample
+          proxy_tasks.put( [ str_sample, dict_tries[ str_sample ], str_command_template.replace( str_placeholder, str_sample ), max( 1, i_lease // 4 ) ] )
+        else:
+          print "Failed ( " + str_why + " ): " + str_sample + ", see " + str_sample + ".err"
+          del dict_tries[ str_sample ]
+          del proxy_current[ str_sample ]
+          i_failed = i_failed + 1
+
+    # None tells the workers the queue is finished, each puts it back for the next
+    proxy_tasks.put( None )
+    time.sleep( i_queue_linger )
+  finally:
+    mngr_queue.shutdown()
+  print "Finished " + str( i_samples - i_failed ) + " samples, " + str( i_failed ) + " failed."
+  return i_failed
+
+
+def func_work_queue( str_address, str_authkey ):
+  """
+  Worker of the work queue mode. Takes commands from the coordinator at str_address and runs them
+  ( func_run_local ) until the queue is finished or the coordinator goes away. Reports when it starts
+  a task, heartbeats while it runs so the coordinator keeps its lease, and reports the exit code.
+  Tasks whose attempt is not current any more ( retried elsewhere or the sample finished ) are dropped, or
+  stopped at the next heartbeat if running, and samples with a done marker are reported done without running.
+
+  * str_address : String
+                : host:port of the coordinator
+  * str_authkey : String
+                : Shared key of the coordinator
+  """
+
+  TaskManager.register( "get_tasks" )
+  TaskManager.register( "get_results" )
+  TaskManager.register( "get_current", proxytype = multiprocessing.managers.DictProxy )
+  mngr_queue = TaskManager( address = func_parse_address( str_address ), authkey = str_authkey )
+  str_host = socket.gethostname()
+  try:
+    mngr_queue.connect()
+    proxy_tasks = mngr_queue.get_tasks()
+    proxy_results = mngr_queue.get_results()
+    proxy_current = mngr_queue.get_current()
+
+    def func_heartbeat():
+      proxy_results.put( [ "alive", str_sample, i_attempt, None, str_host ] )
+      return proxy_current.get( str_sample ) == i_attempt
+
+    while True:
+      lstr_task = proxy_tasks.get()
+      if lstr_task is None:
+        proxy_tasks.put( None )
+        return
+      str_sample, i_attempt, str_command, i_heartbeat = lstr_task
+      if proxy_current.get( str_sample ) != i_attempt:
+        continue
+      if os.path.exists( str_sample + str_done_extension ):
+        proxy_results.put( [ "done", str_sample, i_attempt, 0, str_host ] )
+        continue
+      proxy_results.put( [ "start", str_sample, i_attempt, None, str_host ] )
+      str_sample, i_return = func_run_local( str_sample, str_command, func_heartbeat, i_heartbeat )
+      proxy_results.put( [ "done", str_sample, i_attempt, i_return, str_host ] )
+  except ( EOFError, IOError, socket.error ):
+    # The coordinator finished and shut down
+    return
+  except multiprocessing.AuthenticationError:
+    print "The coordinator at " + str_address + " rejected the --authkey."
+    return
+
+
 # Parse arguments
 prsr_arguments = argparse.ArgumentParser( prog = "make_bsub.py", description = "Helps make many bsub commands.", formatter_class = argparse.ArgumentDefaultsHelpFormatter )
-prsr_arguments.add_argument( "-c", "--command", metavar = "Command_Template", dest = "str_command_template", default = None, required = True, help = "The command to bsub with " + str_placeholder + " which will be replaced by sample names." )
+prsr_arguments.add_argument( "-c", "--command", metavar = "Command_Template", dest = "str_command_template", default = None, help = "The command to bsub with " + str_placeholder + " which will be replaced by sample names." )
 prsr_arguments.add_argument( "-e", "--email", dest = "f_email", action = "store_true", default = False, help = "If this flag is given an email will be generated to you for EACH command given containing the status of the run." )
 prsr_arguments.add_argument( "-g", "--group", type = int, metavar = "Group_Size", dest = "i_group_size", default = 10, help = "The number of bsub commands per file made." )
 prsr_arguments.add_argument( "-m", "--memory", metavar = "Memory", dest = "str_memory", default = "8", help = "The amount of memory in GB needed." )
 prsr_arguments.add_argument( "-o", "--out", metavar = "Output_File", dest = "str_out_file", default = "output_bsub", help = "The base name of the sh file(s) that will be created." )
 prsr_arguments.add_argument( "-q", "--queue", metavar = "Queue", dest = "str_queue", default = "regevlab", help = "The queue to bsub in." )
-prsr_arguments.add_argument( "-s", "--samples", metavar = "Sample_File", dest = "str_sample_file", default = None, required = True,  help = "The file containing samples. One sample name per line (abs paths if needed should be in the file)." )
+prsr_arguments.add_argument( "-s", "--samples", metavar = "Sample_File", dest = "str_sample_file", default = None, help = "The file containing samples. One sample name per line (abs paths if needed should be in the file)." )
+prsr_arguments.add_argument( "--array", dest = "f_array", action = "store_true", default = False, help = "Write one LSF job array submission for all samples ( with an index file of the samples and a task script ) instead of one bsub per sample." )
+prsr_arguments.add_argument( "--array_limit", type = int, metavar = "Max_Running", dest = "i_array_limit", default = 100, help = "With --array, the most array tasks LSF runs at once in total ( the %%K throttle ), 0 for no limit. When the samples are split into several arrays by --array_max, each array starts when the one before it ends, so the limit holds over all of them." )
+prsr_arguments.add_argument( "--array_max", type = int, metavar = "Max_Array_Size", dest = "i_array_max", default = 1000, help = "With --array, the most tasks in one array, MAX_JOB_ARRAY_SIZE in lsb.params. More samples are split into several arrays." )
+prsr_arguments.add_argument( "--job_name", metavar = "Job_Name", dest = "str_job_name", default = None, help = "With --array, the name of the job array. The base name of the output file if not given." )
+prsr_arguments.add_argument( "--local", dest = "f_local", action = "store_true", default = False, help = "Run the commands on this host instead of writing bsub scripts. As many run at once as fit in the host memory at --memory GB each, at most one per core. Samples finished by an earlier run are skipped." )
+prsr_arguments.add_argument( "--local_workers", type = int, metavar = "Workers", dest = "i_local_workers", default = 0, help = "With --local, run this many commands at once instead of working it out from --memory." )
+prsr_arguments.add_argument( "--balance", dest = "f_balance", action = "store_true", default = False, help = "Pack the commands into the sh files by estimated cost, longest first, so the files take about the same time. Keeps the number of files -g gives. The cost is the size of the files of the sample the command names, or else of the files starting with the sample name, unless --cost_column is given. Files shared by all samples, like a reference, are not counted." )
+prsr_arguments.add_argument( "--cost_column", dest = "f_cost_column", action = "store_true", default = False, help = "The sample file has a second, tab delimited, column with the cost of each sample ( for example its runtime or input size ). Used by --balance, which it turns on." )
+prsr_arguments.add_argument( "--serve", metavar = "Host:Port", dest = "str_serve_address", default = None, help = "Instead of writing bsub scripts, serve the commands from a queue on this address ( :port for all interfaces ) to workers started with --work on any host. Samples finished by an earlier run are skipped." )
+prsr_arguments.add_argument( "--work", metavar = "Host:Port", dest = "str_work_address", default = None, help = "Run commands from the --serve coordinator at this address, as many at once as --local would. Only --authkey, --memory and --local_workers are used." )
+prsr_arguments.add_argument( "--authkey", metavar = "Key", dest = "str_authkey", default = None, help = "Shared key of the --serve coordinator and its workers, anyone with it can run commands on the workers. Required by --work, --serve makes and prints a random one if not given." )
+prsr_arguments.add_argument( "--retries", type = int, metavar = "Retries", dest = "i_retries", default = 2, help = "With --serve, times a failed sample is queued again." )
+prsr_arguments.add_argument( "--lease", type = int, metavar = "Seconds", dest = "i_lease", default = 300, help = "With --serve, seconds without a heartbeat from the worker running a sample before it is counted as failed and retried. Workers heartbeat four times per lease." )
 args = prsr_arguments.parse_args()
 
+# Work for a coordinator, which holds the commands
+if args.str_work_address:
+  if not args.str_authkey:
+    prsr_arguments.error( "--work needs the --authkey of the coordinator." )
+  i_workers = args.i_local_workers if args.i_local_workers > 0 else func_local_workers( args.str_memory )
+  lprc_workers = [ multiprocessing.Process( target = func_work_queue, args = ( args.str_work_address, args.str_authkey ) ) for i_worker in xrange( i_workers ) ]
+  for prc_worker in lprc_workers:
+    prc_worker.start()
+  for prc_worker in lprc_workers:
+    prc_worker.join()
+  exit( 0 )
+
+if not args.str_command_template or not args.str_sample_file:
+  prsr_arguments.error( "-c/--command and -s/--samples are required." )
+
+ls_str_samples = []
+lf_costs = []
 ls_str_commands = []
 
-# Read sample file and create commands based on sample list.
+# Read sample file, one sample per line
 with open( args.str_sample_file, "r" ) as hndl_open_file:
-  for str_sample in hndl_open_file:
+  for i_line, str_sample in enumerate( hndl_open_file ):
 
-    # Trim off endline
+    # Trim off endline, skip blank lines
     str_sample = str_sample.replace( os.linesep, "" )
+    if not str_sample.strip():
+      continue
+    if args.f_cost_column:
+      ls_str_columns = str_sample.split( str_cost_delimiter )
+      try:
+        lf_costs.append( float( ls_str_columns[ 1 ] ) )
+      except ( IndexError, ValueError ):
+        print "Line " + str( i_line + 1 ) + " of the sample file needs a tab delimited cost after the sample name. Line = " + str_sample
+        exit( 1 )
+      str_sample = ls_str_columns[ 0 ]
+    ls_str_samples.append( str_sample )
+
+# Run here instead of on LSF
+if args.f_local:
+  i_failed = func_run_all_local( ls_str_samples, args.str_command_template, args.i_local_workers if args.i_local_workers > 0 else func_local_workers( args.str_memory ) )
+  exit( 1 if i_failed else 0 )
+
+# Serve the commands to workers on other hosts
+if args.str_serve_address:
+  if not args.str_authkey:
+    args.str_authkey = binascii.hexlify( os.urandom( 16 ) )
+    print "Start workers with --authkey " + args.str_authkey
+  i_failed = func_serve_queue( ls_str_samples, args.str_command_template, args.str_serve_address, args.str_authkey, args.i_retries, args.i_lease )
+  exit( 1 if i_failed else 0 )
+
+# Options shared by all bsub commands
+str_bsub_options = "-q " + args.str_queue + " -R rusage[mem=" + args.str_memory + "] "
+
+# Add email if requested
+if args.f_email:
+  str_bsub_options = str_bsub_options + "-N "
+
+# One job array for all samples
+if args.f_array:
+  func_write_array( ls_str_samples, args.str_command_template, args.str_out_file, args.str_job_name or os.path.basename( args.str_out_file ), args.i_array_limit, args.i_array_max, str_bsub_options )
+  exit( 0 )
+
+# Create commands based on sample list.
+for str_sample in ls_str_samples:
 
-    # Start command
-    str_command = "bsub -q " + args.str_queue + " -R rusage[mem=" + args.str_memory + "] "
+  # Start command
+  str_command = "bsub " + str_bsub_options
 
-    # Add email if requested
-    if args.f_email:
-      str_command = str_command + "-N "
+  # Add error and out files
+  str_command = str_command + "-e " + str_sample + ".err -o " + str_sample + ".out "
 
-    # Add error and out files
-    str_command = str_command + "-e " + str_sample + ".err -o " + str_sample + ".out "
+  # Make command
+  # Add command
+  str_command = str_command + args.str_command_template.replace( str_placeholder, str_sample )
 
-    # Make command
-    # Add command
-    str_command = str_command + args.str_command_template.replace( str_placeholder, str_sample )
+  ls_str_commands.append( str_command )
 
-    ls_str_commands.append( str_command )
+# Write commands balanced by cost over as many files as plain grouping would make
+if args.f_balance or args.f_cost_column:
+  if not args.f_cost_column:
+    lf_costs = [ func_sample_size( str_sample, args.str_command_template.replace( str_placeholder, str_sample ) ) for str_sample in ls_str_samples ]
+  i_groups = max( 1, ( len( ls_str_commands ) + args.i_group_size - 1 ) // args.i_group_size )
+  for i_file_index, ls_str_group in enumerate( func_balance_groups( ls_str_commands, lf_costs, i_groups ) ):
+    with open( args.str_out_file + str( i_file_index ) + ".sh", "w" ) as hndl_out:
+      for str_command in ls_str_group:
+        hndl_out.write( str_command + os.linesep )
+  exit( 0 )
 
 # Write commands to ( multiple sh scripts to run )
 i_file_index = 0
@@ -6,36 +6,461 @@ CHR_TRANSCRIPT_COMMENT = ">"
 LSTR_COMMENTS = [ CHR_VCF_COMMENT, CHR_TRANSCRIPT_COMMENT ]
 STR_RESULT_DELIMITER = "\t"
 
+# Contigs sorted after the numbered chromosomes, in this order
+LSTR_SEX_MITO_CONTIGS = [ "X", "Y", "M", "MT" ]
+
+# Rough python overhead per VCF line held in memory while sorting
+I_LINE_OVERHEAD = 100
+
+# Sorted runs kept open before they are merged into one, keeps under the open file limit
+I_MAX_OPEN_RUNS = 64
+
+# BGZF ( blocked gzip ) output, uncompressed bytes per block as in htslib and the empty end of file block
+I_BGZF_BLOCK = 0xff00
+STR_BGZF_EOF = "1f8b08040000000000ff0600424302001b0003000000000000000000".decode( "hex" )
+
+# Tabix / CSI index of the BGZF output
+STR_INDEX_TBI = "tbi"
+STR_INDEX_CSI = "csi"
+LSTR_INDEX_CHOICES = [ STR_INDEX_TBI, STR_INDEX_CSI ]
+I_INDEX_MIN_SHIFT = 14
+I_INDEX_DEPTH = 5
+# Tabix preset for VCF [ format, sequence column, begin column, end column, meta character, lines to skip ]
+LI_TABIX_VCF_CONF = [ 2, 1, 2, 0, ord( CHR_VCF_COMMENT ), 0 ]
+
+# What to do with REF alleles which do not match the --reference genome
+STR_REF_FLAG = "flag"
+STR_REF_REPAIR = "repair"
+LSTR_REF_CHOICES = [ STR_REF_FLAG, STR_REF_REPAIR ]
+STR_REF_MISMATCH_FILTER = "REF_MISMATCH"
+I_VCF_CHR_INDEX = 0
+I_VCF_POS_INDEX = 1
+I_VCF_REF_INDEX = 3
+I_VCF_ALT_INDEX = 4
+I_VCF_FILTER_INDEX = 6
+
+# Genotypes in the multi-sample batch output
+STR_GT_CALLED = "0/1"
+STR_GT_MISSING = "./."
+
 import argparse
 import csv
 import datetime
+import heapq
+import mmap
+import multiprocessing
 import os
+import shutil
 import string
+import struct
+import tempfile
+import zlib
 
-prsr_arguments = argparse.ArgumentParser( prog = "mae_vcf_from_gmap_result.py", description = "Output from GMAP is changed to VCF file.", formatter_class = argparse.ArgumentDefaultsHelpFormatter )
-prsr_arguments.add_argument( "str_input_file", help = "Input gmap result file." )
-prsr_arguments.add_argument( "str_output_file", help = "Output SNP vcf file." )
-args = prsr_arguments.parse_args()
+# Used to complement the bases
+sbuff_complement = string.maketrans( "ACGTacgt", "TGCAtgca" )
 
-# Holds the synthetic transcript name
-str_transcript_name = None
 
-# File name base without extension
-str_file = os.path.splitext( os.path.basename( args.str_input_file ) )[ 0 ]
+def func_contig_rank( str_chr ):
+  """
+  Sort rank of a contig so chromosomes come out in genomic order ( chr2 before chr10 ).
+  Numbered chromosomes first, then X, Y, M / MT, then anything else by name.
 
-# Holds the VCF file a it is being built
-lstr_header = [ "##fileformat=VCFv4.2", "##fileDate=" + str( datetime.date.today() ), "##Synthetically derived" ]
-lstr_header.append( "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">" )
-lstr_header.append( "\t".join( [ "#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", str_file ] ) )
-lstr_vcf = []
+  * str_chr : String
+            : Contig name, with or without chr
+  """
 
-# Used to complement the bases
-sbuff_complement = string.maketrans( "ACGTacgt", "TGCAtgca" )
+  str_name = str_chr[ 3: ] if str_chr[ 0:3 ].lower() == "chr" else str_chr
+  if str_name.isdigit():
+    return ( 0, int( str_name ), "" )
+  if str_name.upper() in LSTR_SEX_MITO_CONTIGS:
+    return ( 1, LSTR_SEX_MITO_CONTIGS.index( str_name.upper() ), "" )
+  return ( 2, 0, str_name )
+
+
+def func_vcf_key( str_vcf_line ):
+  """
+  Sort key of a VCF body line, ( contig rank, integer position, line ).
+
+  * str_vcf_line : String
+                 : VCF line without line ending
+  """
+
+  lstr_line = str_vcf_line.split( "\t", 2 )
+  return ( func_contig_rank( lstr_line[ 0 ] ), int( lstr_line[ 1 ] ), str_vcf_line )
+
+
+def func_iter_run( hndl_run ):
+  """
+  Read back a sorted run as ( key, line ) so runs can be merged.
+
+  * hndl_run : File handle
+             : Temp file of sorted VCF lines
+  """
+
+  hndl_run.seek( 0 )
+  for str_line in hndl_run:
+    str_line = str_line.rstrip( "\n" )
+    yield ( func_vcf_key( str_line ), str_line )
+
+
+def func_external_sort( iter_vcf_lines, i_memory_bytes, str_temp_dir = None ):
+  """
+  Sort VCF lines by ( contig rank, position ) holding at most about i_memory_bytes in memory.
+  When the budget is full the lines are sorted and spilled to a temp file, the runs are merged at the end.
+  Yields the sorted lines.
+
+  * iter_vcf_lines : Iterator
+                   : VCF body lines without line endings
+  * i_memory_bytes : Integer
+                   : Memory budget for lines held before spilling
+  * str_temp_dir : String
+                 : Directory for the sorted runs, the system temp dir if None
+  """
+
+  lhndl_runs = []
+  lstr_buffer = []
+  i_buffered = 0
+  try:
+    for str_vcf_line in iter_vcf_lines:
+      lstr_buffer.append( str_vcf_line )
+      i_buffered += len( str_vcf_line ) + I_LINE_OVERHEAD
+      if i_buffered >= i_memory_bytes:
+        lstr_buffer.sort( key = func_vcf_key )
+        hndl_run = tempfile.TemporaryFile( dir = str_temp_dir )
+        hndl_run.writelines( [ str_line + "\n" for str_line in lstr_buffer ] )
+        lhndl_runs.append( hndl_run )
+        lstr_buffer = []
+        i_buffered = 0
+        if len( lhndl_runs ) >= I_MAX_OPEN_RUNS:
+          hndl_merged = tempfile.TemporaryFile( dir = str_temp_dir )
+          hndl_merged.writelines( ( str_line + "\n" for tpl_key, str_line in heapq.merge( *[ func_iter_run( hndl_run ) for hndl_run in lhndl_runs ] ) ) )
+          for hndl_run in lhndl_runs:
+            hndl_run.close()
+          lhndl_runs = [ hndl_merged ]
+    lstr_buffer.sort( key = func_vcf_key )
+
+    # Everything fit in memory
+    if not lhndl_runs:
+      for str_vcf_line in lstr_buffer:
+        yield str_vcf_line
+      return
+
+    # Merge the spilled runs with what is left in memory
+    lgen_runs = [ func_iter_run( hndl_run ) for hndl_run in lhndl_runs ]
+    lgen_runs.append( ( ( func_vcf_key( str_line ), str_line ) for str_line in lstr_buffer ) )
+    for tpl_key, str_vcf_line in heapq.merge( *lgen_runs ):
+      yield str_vcf_line
+  finally:
+    for hndl_run in lhndl_runs:
+      hndl_run.close()
+
+
+def func_bgzf_open( str_file ):
+  """
+  Open a BGZF file for writing. Returns the writer state used by the other func_bgzf functions.
+
+  * str_file : String
+             : Path to write
+  """
+
+  return { "hndl":open( str_file, "wb" ), "pieces":[], "size":0, "block_offset":0 }
+
+
+def func_bgzf_write_block( dict_bgzf, str_data ):
+  """
+  Compress and write one BGZF block ( a gzip member with the BC extra field holding its size ).
+
+  * dict_bgzf : Dictionary
+              : Writer state from func_bgzf_open
+  * str_data : String
+             : Uncompressed data, at most I_BGZF_BLOCK bytes
+  """
+
+  obj_compress = zlib.compressobj( 6, zlib.DEFLATED, -15 )
+  str_compressed = obj_compress.compress( str_data ) + obj_compress.flush()
+  i_block_size = 18 + len( str_compressed ) + 8
+  dict_bgzf[ "hndl" ].write( struct.pack( "<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, i_block_size - 1 ) )
+  dict_bgzf[ "hndl" ].write( str_compressed )
+  dict_bgzf[ "hndl" ].write( struct.pack( "<II", zlib.crc32( str_data ) & 0xffffffff, len( str_data ) ) )
+  dict_bgzf[ "block_offset" ] += i_block_size
+
+
+def func_bgzf_write( dict_bgzf, str_data ):
+  """
+  Write data to a BGZF file, compressing each block as it fills.
+
+  * dict_bgzf : Dictionary
+              : Writer state from func_bgzf_open
+  * str_data : String
+             : Data to write
+  """
+
+  dict_bgzf[ "pieces" ].append( str_data )
+  dict_bgzf[ "size" ] += len( str_data )
+  if dict_bgzf[ "size" ] < I_BGZF_BLOCK:
+    return
+  str_buffer = "".join( dict_bgzf[ "pieces" ] )
+  i_start = 0
+  while len( str_buffer ) - i_start >= I_BGZF_BLOCK:
+    func_bgzf_write_block( dict_bgzf, str_buffer[ i_start : i_start + I_BGZF_BLOCK ] )
+    i_start += I_BGZF_BLOCK
+  dict_bgzf[ "pieces" ] = [ str_buffer[ i_start: ] ]
+  dict_bgzf[ "size" ] = len( str_buffer ) - i_start
+
+
+def func_bgzf_tell( dict_bgzf ):
+  """
+  Virtual offset of the next byte written, ( compressed block offset << 16 ) | offset in the block.
+
+  * dict_bgzf : Dictionary
+              : Writer state from func_bgzf_open
+  """
+
+  return ( dict_bgzf[ "block_offset" ] << 16 ) | dict_bgzf[ "size" ]
+
+
+def func_bgzf_close( dict_bgzf ):
+  """
+  Write what is left and the end of file block, then close.
+
+  * dict_bgzf : Dictionary
+              : Writer state from func_bgzf_open
+  """
+
+  if dict_bgzf[ "size" ]:
+    func_bgzf_write_block( dict_bgzf, "".join( dict_bgzf[ "pieces" ] ) )
+  dict_bgzf[ "hndl" ].write( STR_BGZF_EOF )
+  dict_bgzf[ "hndl" ].close()
+
+
+def func_reg2bin( i_beg, i_end ):
+  """
+  Smallest index bin holding the 0 based, half open region [ i_beg, i_end ).
+
+  * i_beg : Integer
+          : Start of the region
+  * i_end : Integer
+          : End of the region
+  """
+
+  i_end -= 1
+  i_shift = I_INDEX_MIN_SHIFT
+  i_level_first = ( ( 1 << ( 3 * I_INDEX_DEPTH ) ) - 1 ) // 7
+  for i_level in xrange( I_INDEX_DEPTH, 0, -1 ):
+    if ( i_beg >> i_shift ) == ( i_end >> i_shift ):
+      return i_level_first + ( i_beg >> i_shift )
+    i_shift += 3
+    i_level_first = ( ( 1 << ( 3 * ( i_level - 1 ) ) ) - 1 ) // 7
+  return 0
+
+
+def func_bin_first_window( i_bin ):
+  """
+  Linear index window ( 16kb ) holding the start of a bin.
+
+  * i_bin : Integer
+          : Index bin
+  """
+
+  i_level = 0
+  while i_bin >= ( ( 1 << ( 3 * ( i_level + 1 ) ) ) - 1 ) // 7:
+    i_level += 1
+  i_bin_beg = ( i_bin - ( ( 1 << ( 3 * i_level ) ) - 1 ) // 7 ) << ( I_INDEX_MIN_SHIFT + 3 * ( I_INDEX_DEPTH - i_level ) )
+  return i_bin_beg >> I_INDEX_MIN_SHIFT
+
+
+def func_index_add( ldict_refs, str_chr, i_beg, i_end, i_vstart, i_vend ):
+  """
+  Add a record to the index being built. Records must come sorted by contig and position.
+
+  * ldict_refs : List
+               : One { "name", "bins", "linear" } per contig, updated
+  * str_chr : String
+            : Contig of the record
+  * i_beg : Integer
+          : 0 based start of the record
+  * i_end : Integer
+          : 0 based, exclusive end of the record
+  * i_vstart : Integer
+             : Virtual offset of the start of the record
+  * i_vend : Integer
+           : Virtual offset just past the record
+  """
+
+  if not ldict_refs or not ldict_refs[ -1 ][ "name" ] == str_chr:
+    ldict_refs.append( { "name":str_chr, "bins":{}, "linear":[] } )
+  dict_ref = ldict_refs[ -1 ]
+
+  # Chunks of the bin, grown while records are next to each other in the file
+  lli_chunks = dict_ref[ "bins" ].setdefault( func_reg2bin( i_beg, i_end ), [] )
+  if lli_chunks and lli_chunks[ -1 ][ 1 ] == i_vstart:
+    lli_chunks[ -1 ][ 1 ] = i_vend
+  else:
+    lli_chunks.append( [ i_vstart, i_vend ] )
+
+  # Linear index, first record overlapping each 16kb window
+  li_linear = dict_ref[ "linear" ]
+  i_last_window = ( i_end - 1 ) >> I_INDEX_MIN_SHIFT
+  if len( li_linear ) <= i_last_window:
+    li_linear.extend( [ 0 ] * ( i_last_window + 1 - len( li_linear ) ) )
+  for i_window in xrange( i_beg >> I_INDEX_MIN_SHIFT, i_last_window + 1 ):
+    if not li_linear[ i_window ]:
+      li_linear[ i_window ] = i_vstart
+
+
+def func_write_index( ldict_refs, str_index_file, str_index_format ):
+  """
+  Write the BGZF compressed tabix ( .tbi ) or CSI ( .csi ) index for the VCF preset.
+
+  * ldict_refs : List
+               : Index built by func_index_add
+  * str_index_file : String
+                   : Path to write the index to
+  * str_index_format : String
+                     : One of LSTR_INDEX_CHOICES
+  """
+
+  str_names = "".join( [ dict_ref[ "name" ] + "\0" for dict_ref in ldict_refs ] )
+  str_conf = struct.pack( "<6i", *LI_TABIX_VCF_CONF ) + struct.pack( "<i", len( str_names ) ) + str_names
+  if str_index_format == STR_INDEX_CSI:
+    lstr_index = [ "CSI\1", struct.pack( "<3i", I_INDEX_MIN_SHIFT, I_INDEX_DEPTH, len( str_conf ) ), str_conf, struct.pack( "<i", len( ldict_refs ) ) ]
+  else:
+    lstr_index = [ "TBI\1", struct.pack( "<i", len( ldict_refs ) ), str_conf ]
+
+  for dict_ref in ldict_refs:
+    # Windows with no records point at the previous record
+    li_linear = dict_ref[ "linear" ]
+    for i_window in xrange( 1, len( li_linear ) ):
+      if not li_linear[ i_window ]:
+        li_linear[ i_window ] = li_linear[ i_window - 1 ]
+
+    lstr_index.append( struct.pack( "<i", len( dict_ref[ "bins" ] ) ) )
+    for i_bin in sorted( dict_ref[ "bins" ] ):
+      lli_chunks = dict_ref[ "bins" ][ i_bin ]
+      if str_index_format == STR_INDEX_CSI:
+        i_window = func_bin_first_window( i_bin )
+        i_loffset = li_linear[ min( i_window, len( li_linear ) - 1 ) ] if i_window < len( li_linear ) else lli_chunks[ 0 ][ 0 ]
+        lstr_index.append( struct.pack( "<IQi", i_bin, min( i_loffset, lli_chunks[ 0 ][ 0 ] ), len( lli_chunks ) ) )
+      else:
+        lstr_index.append( struct.pack( "<Ii", i_bin, len( lli_chunks ) ) )
+      lstr_index.extend( [ struct.pack( "<QQ", i_vstart, i_vend ) for i_vstart, i_vend in lli_chunks ] )
+    if str_index_format == STR_INDEX_TBI:
+      lstr_index.append( struct.pack( "<i", len( li_linear ) ) )
+      lstr_index.append( struct.pack( "<%dQ" % len( li_linear ), *li_linear ) )
+
+  dict_bgzf = func_bgzf_open( str_index_file )
+  func_bgzf_write( dict_bgzf, "".join( lstr_index ) )
+  func_bgzf_close( dict_bgzf )
+
+
+def func_read_fai( str_reference ):
+  """
+  Read the samtools faidx index of the reference. Returns { name : [ length, offset, line bases, line width ] }.
+
+  * str_reference : String
+                  : Path to the reference fasta, <reference>.fai must exist
+  """
+
+  dict_fai = {}
+  with open( str_reference + ".fai", "r" ) as hndl_fai:
+    for lstr_line in csv.reader( hndl_fai, delimiter = "\t" ):
+      if lstr_line:
+        dict_fai[ lstr_line[ 0 ] ] = [ int( str_value ) for str_value in lstr_line[ 1:5 ] ]
+  return dict_fai
+
+
+def func_reference_bases( mmap_reference, dict_fai, str_chr, i_pos, i_length ):
+  """
+  Bases of the reference at a 1 based position, read from the memory map through the .fai offsets.
+  Returns None if the contig is not in the reference ( chr is added or removed to find it ) or the position is off the end.
+
+  * mmap_reference : mmap
+                   : Memory map of the reference fasta
+  * dict_fai : Dictionary
+             : Index from func_read_fai
+  * str_chr : String
+            : Contig
+  * i_pos : Integer
+          : 1 based position
+  * i_length : Integer
+             : Number of bases
+  """
+
+  l_entry = dict_fai.get( str_chr )
+  if l_entry is None:
+    l_entry = dict_fai.get( str_chr[ 3: ] if str_chr[ 0:3 ].lower() == "chr" else "chr" + str_chr )
+  if l_entry is None:
+    return None
+  i_contig_length, i_offset, i_line_bases, i_line_width = l_entry
+  i_last = i_pos + i_length - 1
+  if i_pos < 1 or i_last > i_contig_length:
+    return None
+  i_first_byte = i_offset + ( ( i_pos - 1 ) // i_line_bases ) * i_line_width + ( i_pos - 1 ) % i_line_bases
+  if i_length == 1:
+    return mmap_reference[ i_first_byte ].upper()
+  i_last_byte = i_offset + ( ( i_last - 1 ) // i_line_bases ) * i_line_width + ( i_last - 1 ) % i_line_bases
+  return mmap_reference[ i_first_byte : i_last_byte + 1 ].translate( None, "\r\n" ).upper()
+
+
+def func_check_reference( iter_vcf_lines, str_reference, str_action, dict_counts ):
+  """
+  Check the REF allele of each VCF line against the reference genome without loading it in memory.
+  Mismatches are flagged with the REF_MISMATCH filter, or repaired: REF becomes the reference base,
+  and if the reference matches ALT instead the alleles are swapped.
+
+  * iter_vcf_lines : Iterator
+                   : VCF body lines without line endings
+  * str_reference : String
+                  : Path to the reference fasta with a .fai index
+  * str_action : String
+               : One of LSTR_REF_CHOICES
+  * dict_counts : Dictionary
+                : Counts of checked, mismatched and not found sites, updated
+  """
+
+  dict_fai = func_read_fai( str_reference )
+  with open( str_reference, "rb" ) as hndl_reference:
+    mmap_reference = mmap.mmap( hndl_reference.fileno(), 0, access = mmap.ACCESS_READ )
+    try:
+      for str_vcf_line in iter_vcf_lines:
+        lstr_vcf_line = str_vcf_line.split( "\t" )
+        str_ref = lstr_vcf_line[ I_VCF_REF_INDEX ]
+        str_genome = func_reference_bases( mmap_reference, dict_fai, lstr_vcf_line[ I_VCF_CHR_INDEX ], int( lstr_vcf_line[ I_VCF_POS_INDEX ] ), len( str_ref ) )
+        if str_genome is None:
+          dict_counts[ "not_found" ] += 1
+          yield str_vcf_line
+          continue
+        dict_counts[ "checked" ] += 1
+        if str_genome == str_ref:
+          yield str_vcf_line
+          continue
+        dict_counts[ "mismatched" ] += 1
+        if str_action == STR_REF_REPAIR:
+          if str_genome == lstr_vcf_line[ I_VCF_ALT_INDEX ]:
+            lstr_vcf_line[ I_VCF_ALT_INDEX ] = str_ref
+          lstr_vcf_line[ I_VCF_REF_INDEX ] = str_genome
+        else:
+          lstr_vcf_line[ I_VCF_FILTER_INDEX ] = STR_REF_MISMATCH_FILTER
+        yield "\t".join( lstr_vcf_line )
+    finally:
+      mmap_reference.close()
+
+
+def func_read_gmap( str_input_file ):
+  """
+  Yield the VCF body lines made from a gmap result file, in file order.
+
+  * str_input_file : String
+                   : Path to the gmap result file
+  """
+
+  # Holds the synthetic transcript name
+  str_transcript_name = None
+
+  # Read in gmap result file
+  with open( str_input_file, "r" ) as hndl_gmap:
+    for lstr_line in csv.reader( hndl_gmap, delimiter = STR_RESULT_DELIMITER ):
 
-# Read in gmap result file
-with open( args.str_input_file, "r" ) as hndl_gmap:
-  for lstr_line in csv.reader( hndl_gmap, delimiter = STR_RESULT_DELIMITER ):
-      
       # Ignore blank lines and comments, pull out transcript names
       if not lstr_line:
         continue
@@ -49,17 +474,180 @@ with open( args.str_input_file, "r" ) as hndl_gmap:
       ## Manage reverse complement information
       str_alt, str_ref = lstr_line[ 0 ].split( "/" )
       if str_chr[ 0 ] == "+":
-          str_chr = str_chr[ 1: ]
+        str_chr = str_chr[ 1: ]
       if str_chr[ 0 ] == "-":
-          str_chr = str_chr[ 1: ]
-          str_alt = str_alt.translate( sbuff_complement )
-          str_ref = str_ref.translate( sbuff_complement )
+        str_chr = str_chr[ 1: ]
+        str_alt = str_alt.translate( sbuff_complement )
+        str_ref = str_ref.translate( sbuff_complement )
       ## Manage VF file name
       if ( len( str_chr ) < 3 ) or not ( str_chr[ 0:3 ].lower() == "chr" ):
         str_chr = "chr" + str_chr
-      lstr_vcf.append( "\t".join( [ str_chr, str_pos, str_transcript_name, str_ref.upper(), str_alt.upper(), ".", "PASS", ".", "GT", "0/1" ] ) )
+      yield "\t".join( [ str_chr, str_pos, str_transcript_name, str_ref.upper(), str_alt.upper(), ".", "PASS", ".", "GT", "0/1" ] )
+
+
+def func_sort_sample( str_input_file, str_sorted_file, str_reference, str_ref_mismatch, i_memory_bytes, str_temp_dir ):
+  """
+  Batch worker, parse one gmap result file, check it against the reference if given and sort it into str_sorted_file.
+  Returns the reference counts. The caller removes the file.
+
+  * str_input_file : String
+                   : Path to the gmap result file
+  * str_sorted_file : String
+                    : Path to write the sorted VCF lines to
+  * str_reference : String
+                  : Reference fasta or None
+  * str_ref_mismatch : String
+                     : One of LSTR_REF_CHOICES
+  * i_memory_bytes : Integer
+                   : Sort memory budget of this worker
+  * str_temp_dir : String
+                 : Directory for the sorted runs, the system temp dir if None
+  """
+
+  dict_counts = { "checked":0, "mismatched":0, "not_found":0 }
+  iter_vcf_lines = func_read_gmap( str_input_file )
+  if str_reference:
+    iter_vcf_lines = func_check_reference( iter_vcf_lines, str_reference, str_ref_mismatch, dict_counts )
+  with open( str_sorted_file, "w" ) as hndl_sorted:
+    for str_vcf_line in func_external_sort( iter_vcf_lines, i_memory_bytes, str_temp_dir ):
+      hndl_sorted.write( str_vcf_line + "\n" )
+  return dict_counts
+
+
+def func_iter_sample( str_sorted_file, i_sample ):
+  """
+  Read back a sorted sample as ( ( contig rank, position ), sample index, split line ) for the k-way merge.
+
+  * str_sorted_file : String
+                    : Sorted VCF lines from func_sort_sample
+  * i_sample : Integer
+             : Column of the sample in the output
+  """
+
+  with open( str_sorted_file, "r" ) as hndl_sorted:
+    for str_line in hndl_sorted:
+      lstr_vcf_line = str_line.rstrip( "\n" ).split( "\t" )
+      yield ( ( func_contig_rank( lstr_vcf_line[ I_VCF_CHR_INDEX ] ), int( lstr_vcf_line[ I_VCF_POS_INDEX ] ) ), i_sample, lstr_vcf_line )
+
+
+def func_merge_samples( lstr_sorted_files ):
+  """
+  K-way merge of sorted single sample VCF lines into multi-sample lines, one genotype column per file.
+  Calls with the same position, REF and ALT become one line, samples without the call get a missing genotype.
+  IDs ( transcripts ) of the merged calls are joined with ; and the line keeps the REF_MISMATCH filter if any call had it.
+
+  * lstr_sorted_files : List of strings
+                      : Sorted files from func_sort_sample, in sample column order
+  """
+
+  i_samples = len( lstr_sorted_files )
+  tpl_site = None
+  dict_calls = {}
+  lgen_samples = [ func_iter_sample( str_sorted_file, i_sample ) for i_sample, str_sorted_file in enumerate( lstr_sorted_files ) ]
+  for tpl_next, i_sample, lstr_vcf_line in heapq.merge( *lgen_samples ) if lgen_samples else []:
+    if tpl_next != tpl_site:
+      for tpl_alleles in sorted( dict_calls ):
+        yield "\t".join( dict_calls[ tpl_alleles ][ 0 ] + dict_calls[ tpl_alleles ][ 1 ] )
+      tpl_site = tpl_next
+      dict_calls = {}
+    tpl_alleles = ( lstr_vcf_line[ I_VCF_REF_INDEX ], lstr_vcf_line[ I_VCF_ALT_INDEX ] )
+    if tpl_alleles not in dict_calls:
+      dict_calls[ tpl_alleles ] = [ lstr_vcf_line[ :I_VCF_FILTER_INDEX + 3 ], [ STR_GT_MISSING ] * i_samples ]
+    else:
+      lstr_merged = dict_calls[ tpl_alleles ][ 0 ]
+      if lstr_vcf_line[ I_VCF_FILTER_INDEX ] != "PASS":
+        lstr_merged[ I_VCF_FILTER_INDEX ] = lstr_vcf_line[ I_VCF_FILTER_INDEX ]
+      if lstr_vcf_line[ 2 ] not in lstr_merged[ 2 ].split( ";" ):
+        lstr_merged[ 2 ] += ";" + lstr_vcf_line[ 2 ]
+    dict_calls[ tpl_alleles ][ 1 ][ i_sample ] = STR_GT_CALLED
+  for tpl_alleles in sorted( dict_calls ):
+    yield "\t".join( dict_calls[ tpl_alleles ][ 0 ] + dict_calls[ tpl_alleles ][ 1 ] )
+
+
+prsr_arguments = argparse.ArgumentParser( prog = "mae_vcf_from_gmap_result.py", description = "Output from GMAP is changed to VCF file.", formatter_class = argparse.ArgumentDefaultsHelpFormatter )
+prsr_arguments.add_argument( "lstr_input_files", metavar = "str_input_file", nargs = "+", help = "Input gmap result file. Give several to make one multi-sample VCF with a genotype column per file." )
+prsr_arguments.add_argument( "str_output_file", help = "Output SNP vcf file." )
+prsr_arguments.add_argument( "--memory_mb", type = int, metavar = "Memory_MB", dest = "i_memory_mb", default = 512, help = "Memory budget for sorting. Past this sorted runs are spilled to temp files and merged." )
+prsr_arguments.add_argument( "--temp_dir", metavar = "Temp_Dir", dest = "str_temp_dir", default = None, help = "Directory for sorted runs, the system temp directory if not given." )
+prsr_arguments.add_argument( "--bgzip", dest = "f_bgzip", action = "store_true", default = False, help = "Write BGZF compressed output with a tabix / CSI index next to it, ready for region queries. On by default if the output file ends in .gz." )
+prsr_arguments.add_argument( "--index_format", dest = "str_index_format", choices = LSTR_INDEX_CHOICES, default = STR_INDEX_TBI, help = "Index written with the BGZF output." )
+prsr_arguments.add_argument( "--reference", metavar = "Reference_Fasta", dest = "str_reference", default = None, help = "Check REF alleles against this genome fasta. Needs a samtools faidx index ( <reference>.fai ), bases are read through a memory map." )
+prsr_arguments.add_argument( "--ref_mismatch", dest = "str_ref_mismatch", choices = LSTR_REF_CHOICES, default = STR_REF_FLAG, help = "With --reference, flag mismatched REF alleles with the " + STR_REF_MISMATCH_FILTER + " filter or repair them from the reference." )
+prsr_arguments.add_argument( "-p", "--processes", type = int, metavar = "Processes", dest = "i_processes", default = 1, help = "With several input files, parse and sort this many files at once. The memory budget is shared between them." )
+args = prsr_arguments.parse_args()
+
+if args.str_reference and not os.path.exists( args.str_reference + ".fai" ):
+  print "The reference needs a .fai index ( samtools faidx or splitFasta.py --index ). Reference = " + args.str_reference
+  exit( 1 )
+
+# File name bases without extension are the sample names
+lstr_samples = [ os.path.splitext( os.path.basename( str_input_file ) )[ 0 ] for str_input_file in args.lstr_input_files ]
+lstr_duplicates = sorted( set( [ str_sample for str_sample in lstr_samples if lstr_samples.count( str_sample ) > 1 ] ) )
+if lstr_duplicates:
+  prsr_arguments.error( "Input files give duplicate sample names, rename them so each genotype column is unique: " + ", ".join( lstr_duplicates ) )
+
+# Holds the VCF file a it is being built
+lstr_header = [ "##fileformat=VCFv4.2", "##fileDate=" + str( datetime.date.today() ), "##Synthetically derived" ]
+lstr_header.append( "##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">" )
+if args.str_reference and args.str_ref_mismatch == STR_REF_FLAG:
+  lstr_header.append( "##FILTER=<ID=" + STR_REF_MISMATCH_FILTER + ",Description=\"REF allele does not match the reference genome\">" )
+lstr_header.append( "\t".join( [ "#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT" ] + lstr_samples ) )
+
+dict_reference_counts = { "checked":0, "mismatched":0, "not_found":0 }
+# Sorted samples of the batch mode, removed however the run ends
+str_sorted_dir = None
+try:
+  if len( args.lstr_input_files ) == 1:
+    # VCF lines, optionally checked against the reference, then sorted
+    iter_vcf = func_read_gmap( args.lstr_input_files[ 0 ] )
+    if args.str_reference:
+      iter_vcf = func_check_reference( iter_vcf, args.str_reference, args.str_ref_mismatch, dict_reference_counts )
+    iter_vcf = func_external_sort( iter_vcf, args.i_memory_mb * 1024 * 1024, args.str_temp_dir )
+  else:
+    # Each sample is parsed and sorted by a worker, the sorted samples are merged position by position
+    i_processes = max( 1, min( args.i_processes, len( args.lstr_input_files ) ) )
+    i_worker_memory = args.i_memory_mb * 1024 * 1024 // i_processes
+    str_sorted_dir = tempfile.mkdtemp( dir = args.str_temp_dir )
+    lstr_sorted_files = [ os.path.join( str_sorted_dir, str( i_sample ) + ".vcf" ) for i_sample in xrange( len( args.lstr_input_files ) ) ]
+    pool_workers = multiprocessing.Pool( i_processes )
+    try:
+      lres_samples = [ pool_workers.apply_async( func_sort_sample, ( str_input_file, str_sorted_file, args.str_reference, args.str_ref_mismatch, i_worker_memory, args.str_temp_dir ) ) for str_input_file, str_sorted_file in zip( args.lstr_input_files, lstr_sorted_files ) ]
+      for res_sample in lres_samples:
+        dict_counts = res_sample.get()
+        for str_count in dict_counts:
+          dict_reference_counts[ str_count ] += dict_counts[ str_count ]
+      pool_workers.close()
+    except:
+      pool_workers.terminate()
+      raise
+    finally:
+      pool_workers.join()
+    iter_vcf = func_merge_samples( lstr_sorted_files )
+
+  # Write out BGZF file sorted by contig and position, indexing each line as it is written
+  if args.f_bgzip or args.str_output_file.endswith( ".gz" ):
+    ldict_refs = []
+    dict_bgzf = func_bgzf_open( args.str_output_file )
+    func_bgzf_write( dict_bgzf, "\n".join( lstr_header ) + "\n" )
+    for str_vcf_line in iter_vcf:
+      lstr_vcf_line = str_vcf_line.split( "\t", 4 )
+      i_vstart = func_bgzf_tell( dict_bgzf )
+      func_bgzf_write( dict_bgzf, str_vcf_line + "\n" )
+      i_beg = int( lstr_vcf_line[ 1 ] ) - 1
+      func_index_add( ldict_refs, lstr_vcf_line[ 0 ], i_beg, i_beg + max( 1, len( lstr_vcf_line[ 3 ] ) ), i_vstart, func_bgzf_tell( dict_bgzf ) )
+    func_bgzf_close( dict_bgzf )
+    func_write_index( ldict_refs, args.str_output_file + "." + args.str_index_format, args.str_index_format )
+  else:
+    # Write out file sorted by contig and position
+    with open( args.str_output_file, "w" ) as hndl_vcf:
+      hndl_vcf.write( "\n".join( lstr_header ) )
+      for str_vcf_line in iter_vcf:
+        hndl_vcf.write( "\n" + str_vcf_line )
+finally:
+  if str_sorted_dir:
+    shutil.rmtree( str_sorted_dir, ignore_errors = True )
 
-# Write out file
-lstr_vcf.sort()
-with open( args.str_output_file, "w" ) as hndl_vcf:
-  hndl_vcf.write( "\n".join( lstr_header + lstr_vcf ) )
+if args.str_reference:
+  print "REF alleles checked: " + str( dict_reference_counts[ "checked" ] )
+  print "REF alleles not matching the reference ( " + args.str_ref_mismatch + " ): " + str( dict_reference_counts[ "mismatched" ] )
+  print "Sites not in the reference: " + str( dict_reference_counts[ "not_found" ] )
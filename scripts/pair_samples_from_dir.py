@@ -9,23 +9,355 @@ __email__ = "ttickle@broadinstitute.org"
 __status__ = "Development"
 
 import argparse
+import gzip
+import itertools
+import json
+import multiprocessing.pool
 import os
+import stat
+import time
+import zlib
+
+# os.scandir ( or the scandir package ) gives file types without a stat per entry, listdir is used without it
+try:
+    from os import scandir as func_scandir
+except ImportError:
+    try:
+        from scandir import scandir as func_scandir
+    except ImportError:
+        func_scandir = None
+
+# Directories changed this close ( seconds ) to their listing may change again within the same mtime, they are not trusted from the snapshot
+i_mtime_slack = 2
+
+# Mate suffixes of old style read names, removed before the names of mates are compared
+ls_mate_suffixes = [ "/1", "/2" ]
 
 str_example_usage = "Example: pair_samples_from_dir.py -t fastq -p _ -d input_dir -o paired_samples.txt"
 
+
+def func_scan_dir( str_dir, str_file_type ):
+    """
+    List one directory. Returns [ list of file names, list of subdirectory paths ].
+    Symbolic links to directories are not followed, a link back up the tree would loop.
+    Without scandir, names ending in the file type are taken as files so only the other names cost a stat.
+
+    * str_dir : String
+              : Directory to list
+    * str_file_type : String
+                    : Suffix of the files to pair
+    """
+
+    ls_files = []
+    ls_subdirs = []
+    if func_scandir:
+        for entry_cur in func_scandir( str_dir ):
+            if entry_cur.is_dir( follow_symlinks = False ):
+                ls_subdirs.append( entry_cur.path )
+            else:
+                ls_files.append( entry_cur.name )
+        return [ ls_files, ls_subdirs ]
+    for str_name in os.listdir( str_dir ):
+        str_path = os.path.join( str_dir, str_name )
+        if not str_name.endswith( str_file_type ) and stat.S_ISDIR( os.lstat( str_path ).st_mode ):
+            ls_subdirs.append( str_path )
+        else:
+            ls_files.append( str_name )
+    return [ ls_files, ls_subdirs ]
+
+
+def func_scan_dir_cached( str_dir, str_file_type, dict_snapshot ):
+    """
+    List one directory unless the snapshot has it with the same mtime.
+    Returns [ list of file names, list of subdirectory paths, snapshot entry or None if it was taken from the snapshot ].
+
+    * str_dir : String
+              : Directory to list
+    * str_file_type : String
+                    : Suffix of the files to pair
+    * dict_snapshot : Dictionary
+                    : { directory : { "mtime", "files", "subdirs" } } of an earlier run, read only here
+    """
+
+    f_mtime = os.stat( str_dir ).st_mtime
+    dict_entry = dict_snapshot.get( str_dir )
+    if dict_entry and dict_entry[ "mtime" ] == f_mtime:
+        return [ dict_entry[ "files" ], dict_entry[ "subdirs" ], None ]
+    ls_files, ls_subdirs = func_scan_dir( str_dir, str_file_type )
+    if time.time() - f_mtime < i_mtime_slack:
+        f_mtime = None
+    return [ ls_files, ls_subdirs, { "mtime":f_mtime, "files":ls_files, "subdirs":ls_subdirs } ]
+
+
+def func_scan_tree( str_dir, str_file_type, i_threads, dict_snapshot = None ):
+    """
+    Walk a directory tree listing the directories of each level at once on a thread pool,
+    metadata latency ( NFS ) and not CPU is what takes the time. Returns { directory : list of file names }.
+    With a snapshot only directories whose mtime changed are listed again, the others cost one stat,
+    and the snapshot is updated to the tree as it is now.
+
+    * str_dir : String
+              : Top directory
+    * str_file_type : String
+                    : Suffix of the files to pair
+    * i_threads : Integer
+                : Directories listed at once
+    * dict_snapshot : Dictionary
+                    : { directory : { "mtime", "files", "subdirs" } } of an earlier run or None, updated
+    """
+
+    dict_files = {}
+    dict_seen = {}
+    ls_level = [ str_dir ]
+    pool_threads = multiprocessing.pool.ThreadPool( max( 1, i_threads ) )
+    try:
+        while ls_level:
+            ls_next_level = []
+            if dict_snapshot is None:
+                llo_listings = [ lls_listing + [ None ] for lls_listing in pool_threads.map( lambda str_cur_dir: func_scan_dir( str_cur_dir, str_file_type ), ls_level ) ]
+            else:
+                llo_listings = pool_threads.map( lambda str_cur_dir: func_scan_dir_cached( str_cur_dir, str_file_type, dict_snapshot ), ls_level )
+            for str_cur_dir, ( ls_files, ls_subdirs, dict_entry ) in zip( ls_level, llo_listings ):
+                dict_files[ str_cur_dir ] = ls_files
+                if dict_snapshot is not None:
+                    dict_seen[ str_cur_dir ] = dict_entry or dict_snapshot[ str_cur_dir ]
+                ls_next_level.extend( ls_subdirs )
+            ls_level = ls_next_level
+        pool_threads.close()
+    except:
+        pool_threads.terminate()
+        raise
+    finally:
+        pool_threads.join()
+
+    # Directories gone since the snapshot are dropped from it
+    if dict_snapshot is not None:
+        dict_snapshot.clear()
+        dict_snapshot.update( dict_seen )
+    return dict_files
+
+
+def func_group_by_key( str_dir, dict_files, str_file_type, str_prefix_sentinel ):
+    """
+    Group the files of the given type by prefix key in one pass, not depending on sort order.
+    Keys of files under subdirectories include the subdirectory ( run1/sampleA ) so runs do not collide.
+    Returns { key : sorted list of absolute paths }.
+
+    * str_dir : String
+              : Top directory the keys are relative to
+    * dict_files : Dictionary
+                 : { directory : list of file names } from func_scan_tree
+    * str_file_type : String
+                    : Suffix of the files to pair
+    * str_prefix_sentinel : String
+                          : End of the key in the file names
+    """
+
+    dict_groups = {}
+    for str_cur_dir, ls_files in dict_files.iteritems():
+        str_rel_dir = os.path.relpath( str_cur_dir, str_dir )
+        str_abs_dir = os.path.abspath( str_cur_dir )
+        for str_file in ls_files:
+            if len( str_file ) <= len( str_file_type ) or not str_file.endswith( str_file_type ):
+                continue
+            i_sentinel = str_file.find( str_prefix_sentinel )
+            if i_sentinel < 0:
+                continue
+            str_key = str_file[ : i_sentinel ]
+            if str_rel_dir != os.curdir:
+                str_key = os.path.join( str_rel_dir, str_key )
+            dict_groups.setdefault( str_key, [] ).append( os.path.join( str_abs_dir, str_file ) )
+    for ls_paths in dict_groups.itervalues():
+        ls_paths.sort()
+    return dict_groups
+
+def func_read_snapshot( str_cache_file ):
+    """
+    Read the directory snapshot of an earlier run, empty if there is none.
+
+    * str_cache_file : String
+                     : JSON snapshot file
+    """
+
+    if not os.path.exists( str_cache_file ):
+        return {}
+    with open( str_cache_file, "r" ) as hndl_cache:
+        return json.load( hndl_cache )
+
+
+def func_write_snapshot( str_cache_file, dict_snapshot ):
+    """
+    Write the directory snapshot, through a temporary file so a failed write keeps the old one.
+
+    * str_cache_file : String
+                     : JSON snapshot file
+    * dict_snapshot : Dictionary
+                    : { directory : { "mtime", "files", "subdirs" } }
+    """
+
+    with open( str_cache_file + ".tmp", "w" ) as hndl_cache:
+        json.dump( dict_snapshot, hndl_cache )
+    os.rename( str_cache_file + ".tmp", str_cache_file )
+
+
+def func_update_sample_file( str_sample_file, dict_lines ):
+    """
+    Bring the sample file up to date with the pairs found. When every pair already in the file is unchanged
+    only the new pairs are appended, otherwise the file is written again. Returns [ pairs added, pairs removed or changed ].
+
+    * str_sample_file : String
+                      : Sample file
+    * dict_lines : Dictionary
+                 : { key : sample file line } of the pairs found
+    """
+
+    dict_old_lines = {}
+    if os.path.exists( str_sample_file ):
+        with open( str_sample_file, "r" ) as hndl_old:
+            for str_line in hndl_old:
+                dict_old_lines[ str_line.split( "\t", 1 )[ 0 ] ] = str_line
+    ls_new_keys = sorted( [ str_key for str_key in dict_lines if str_key not in dict_old_lines ] )
+    i_stale = len( [ str_key for str_key in dict_old_lines if dict_lines.get( str_key ) != dict_old_lines[ str_key ] ] )
+    if i_stale:
+        with open( str_sample_file, "w" ) as hndl_output:
+            hndl_output.writelines( [ dict_lines[ str_key ] for str_key in sorted( dict_lines ) ] )
+    elif ls_new_keys:
+        with open( str_sample_file, "a" ) as hndl_output:
+            hndl_output.writelines( [ dict_lines[ str_key ] for str_key in ls_new_keys ] )
+    return [ len( ls_new_keys ), i_stale ]
+
+
+def func_read_names( str_fastq, i_records ):
+    """
+    Names of the first reads of a fastq ( gzipped or not ), reading and decompressing only as far as needed.
+    The name is the header up to the first whitespace without a /1 or /2 mate suffix.
+
+    * str_fastq : String
+                : Path to the fastq or fastq.gz
+    * i_records : Integer
+                : Number of reads
+    """
+
+    ls_names = []
+    with ( gzip.open( str_fastq, "rb" ) if str_fastq.endswith( ".gz" ) else open( str_fastq, "r" ) ) as hndl_fastq:
+        for str_header in itertools.islice( hndl_fastq, 0, i_records * 4, 4 ):
+            ls_header = str_header[ 1: ].split( None, 1 )
+            str_name = ls_header[ 0 ] if ls_header else ""
+            if str_name[ -2: ] in ls_mate_suffixes:
+                str_name = str_name[ : -2 ]
+            ls_names.append( str_name )
+    return ls_names
+
+
+def func_verify_pair( ls_pair ):
+    """
+    Check the first reads of two mates have the same names. Returns None if they do, otherwise why not.
+
+    * ls_pair : List of strings
+              : [ number of reads, mate 1 path, mate 2 path ]
+    """
+
+    i_records, str_mate_1, str_mate_2 = ls_pair
+    try:
+        ls_names_1 = func_read_names( str_mate_1, i_records )
+        ls_names_2 = func_read_names( str_mate_2, i_records )
+    except ( IOError, EOFError, zlib.error ) as err_read:
+        return "could not be read ( " + str( err_read ) + " )"
+    for i_read, ( str_name_1, str_name_2 ) in enumerate( itertools.izip( ls_names_1, ls_names_2 ) ):
+        if str_name_1 != str_name_2:
+            return "read " + str( i_read + 1 ) + " is " + str_name_1 + " and " + str_name_2
+    if len( ls_names_1 ) != len( ls_names_2 ):
+        return "one mate has fewer reads ( " + str( len( ls_names_1 ) ) + " and " + str( len( ls_names_2 ) ) + " )"
+    return None
+
+
+def func_verify_pairs( dict_pairs, i_records, i_threads ):
+    """
+    Check the read names of the first reads of every pair on a thread pool, decompression releases the GIL.
+    Returns { key : why the pair does not match } for the pairs which do not.
+
+    * dict_pairs : Dictionary
+                 : { key : [ mate 1 path, mate 2 path ] }
+    * i_records : Integer
+                : Reads checked per pair
+    * i_threads : Integer
+                : Pairs checked at once
+    """
+
+    ls_keys = sorted( dict_pairs )
+    pool_threads = multiprocessing.pool.ThreadPool( max( 1, i_threads ) )
+    try:
+        ls_results = pool_threads.map( func_verify_pair, [ [ i_records ] + dict_pairs[ str_key ] for str_key in ls_keys ] )
+        pool_threads.close()
+    except:
+        pool_threads.terminate()
+        raise
+    finally:
+        pool_threads.join()
+    return dict( [ ( str_key, str_result ) for str_key, str_result in zip( ls_keys, ls_results ) if str_result ] )
+
+
+def func_drop_mismatched( dict_pairs, i_records, i_threads ):
+    """
+    Verify the pairs ( func_verify_pairs ), report and remove the ones whose mates do not match.
+
+    * dict_pairs : Dictionary
+                 : { key : [ mate 1 path, mate 2 path ] }, updated
+    * i_records : Integer
+                : Reads checked per pair
+    * i_threads : Integer
+                : Pairs checked at once
+    """
+
+    dict_mismatched = func_verify_pairs( dict_pairs, i_records, i_threads )
+    for str_key in sorted( dict_mismatched ):
+        print "Mates do not match, not paired: " + str_key + ", " + dict_mismatched[ str_key ]
+        del dict_pairs[ str_key ]
+    print "Pairs verified: " + str( len( dict_pairs ) + len( dict_mismatched ) ) + ", mismatched: " + str( len( dict_mismatched ) )
+
+
 # Parse arguments
 prsr_arguments = argparse.ArgumentParser( prog = "pair_samples_from_dir.py", description = "Pair samples in a directory and make a samples file.\t"+str_example_usage )
 prsr_arguments.add_argument( "-d", "--dir", dest = "str_dir_file" , help = "Directory containing samples." )
 prsr_arguments.add_argument( "-t", "--file_type", dest = "str_file_type", help ="Suffix of file to look for." )
 prsr_arguments.add_argument( "-o", "--out", dest = "str_sample_file", help = "Sample file" )
 prsr_arguments.add_argument( "-p", "--prefix", dest = "str_prefix_sentinel", help = "Sentinel for the end of the prefix which is a key in the sample names that matches paired samples. Eg. _ for test_left.txt and test_right.txt" )
+prsr_arguments.add_argument( "-r", "--recursive", dest = "f_recursive", action = "store_true", default = False, help = "Pair files anywhere under the directory, listing directories on a thread pool. Files are grouped by key, so unrelated files do not break pairs, and keys in subdirectories include the subdirectory." )
+prsr_arguments.add_argument( "--threads", type = int, dest = "i_threads", default = 16, help = "With --recursive, directories listed at once. With --verify, pairs checked at once." )
+prsr_arguments.add_argument( "--cache", dest = "str_cache_file", default = None, help = "With --recursive, keep a snapshot of the directories in this file. Later runs only list directories whose mtime changed and add new pairs to the sample file instead of writing it again." )
+prsr_arguments.add_argument( "--verify", type = int, nargs = "?", const = 1000, default = 0, metavar = "Reads", dest = "i_verify_records", help = "Check the read names of the first reads ( 1000 if not given ) match between the mates of each pair, on --threads threads. Pairs which do not match are reported and left out." )
 args = prsr_arguments.parse_args()
 
+if args.str_cache_file and not args.f_recursive:
+    prsr_arguments.error( "--cache needs --recursive." )
+
 # End gracefully on the wrong input directory
 if not os.path.exists( args.str_dir_file ):
     print "Path does not exist. Path = "+ args.str_dir_file
     exit( 1 )
 
+# Group every file in the tree by key, keys with exactly two files are pairs
+if args.f_recursive:
+    dict_snapshot = func_read_snapshot( args.str_cache_file ) if args.str_cache_file else None
+    dict_groups = func_group_by_key( args.str_dir_file, func_scan_tree( args.str_dir_file, args.str_file_type, args.i_threads, dict_snapshot ), args.str_file_type, args.str_prefix_sentinel )
+    ls_keys = sorted( [ str_key for str_key in dict_groups if len( dict_groups[ str_key ] ) == 2 ] )
+    i_unpaired = len( dict_groups ) - len( ls_keys )
+    if i_unpaired:
+        print "Keys without exactly two files, not paired: " + str( i_unpaired )
+    if args.i_verify_records > 0:
+        dict_groups = dict( [ ( str_key, dict_groups[ str_key ] ) for str_key in ls_keys ] )
+        func_drop_mismatched( dict_groups, args.i_verify_records, args.i_threads )
+        ls_keys = sorted( dict_groups )
+    if args.str_cache_file:
+        i_added, i_stale = func_update_sample_file( args.str_sample_file, dict( [ ( str_key, "\t".join( [ str_key ] + dict_groups[ str_key ] + [ "\n" ] ) ) for str_key in ls_keys ] ) )
+        func_write_snapshot( args.str_cache_file, dict_snapshot )
+        print "Pairs added: " + str( i_added ) + ", removed or changed: " + str( i_stale )
+    else:
+        with open( args.str_sample_file, "w" ) as hndl_output:
+            hndl_output.writelines( [ "\t".join( [ str_key ] + dict_groups[ str_key ] + [ "\n" ] ) for str_key in ls_keys ] )
+    print "Pairs found: " + str( len( ls_keys ) )
+    exit( 0 )
+
 # Get directory list    
 ls_dirs = os.listdir( args.str_dir_file )
 i_file_type_len = len( args.str_file_type )
@@ -59,6 +391,10 @@ for str_file in ls_dirs:
         str_prev_sample = str_file
         continue
 
+# Check the mates match
+if args.i_verify_records > 0:
+    func_drop_mismatched( dict_pairs, args.i_verify_records, args.i_threads )
+
 # Write to file format
 # Key\tSample1\tSample2
 with open( args.str_sample_file, "w" ) as hndl_output:
@@ -9,33 +9,503 @@ __email__ = "ttickle@broadinstitute.org"
 __status__ = "Development"
 
 import argparse
+import array
+import hashlib
+import heapq
+import mmap
+import multiprocessing
 import os.path
+import sys
+
+# Extension of the samtools faidx compatible index
+STR_FAI_EXT = ".fai"
+
+# Width of sequence lines written when extracting ( as samtools faidx )
+I_EXTRACT_WIDTH = 60
+
+
+def func_iter_records( hndl_fasta ):
+    """
+    Yield the lines of each record in a fasta file.
+    Lines before the first record are given as their own record.
+
+    * hndl_fasta : File handle
+                 : Handle to the multi-fasta file
+    """
+
+    lstr_content = []
+    for str_line in hndl_fasta:
+        if str_line[ 0 ] == ">" and len( lstr_content ) > 0:
+            yield lstr_content
+            lstr_content = []
+        lstr_content.append( str_line )
+    if len( lstr_content ) > 0:
+        yield lstr_content
+
+
+def func_output_path( str_file_base, i_counter, i_hash_dirs ):
+    """
+    Path of an output file, <base>_<i_counter>.fasta, optionally placed in one of N hashed subdirectories.
+
+    * str_file_base : String
+                    : Base name of the input file
+    * i_counter : Integer
+                : Number of the output file
+    * i_hash_dirs : Integer
+                  : Number of subdirectories to spread files over, 0 for none
+    """
+
+    str_file_name = "".join( [ str_file_base, "_", str( i_counter ), ".fasta" ] )
+    if not i_hash_dirs:
+        return str_file_name
+    i_bucket = int( hashlib.md5( str_file_name ).hexdigest(), 16 ) % i_hash_dirs
+    return os.path.join( "%0*x" % ( len( "%x" % ( i_hash_dirs - 1 ) ), i_bucket ), str_file_name )
+
+
+def func_measure_records( str_fasta_file ):
+    """
+    First pass over the fasta file which only measures the sequence length of each record.
+    Returns an array of lengths in record order ( as given by func_iter_records ).
+
+    * str_fasta_file : String
+                     : Path to the multi-fasta file
+    """
+
+    ai_lengths = array.array( "L" )
+    i_length = 0
+    f_started = False
+    with open( str_fasta_file, "r" ) as hndl_fasta:
+        for str_line in hndl_fasta:
+            if str_line[ 0 ] == ">":
+                if f_started:
+                    ai_lengths.append( i_length )
+                f_started = True
+                i_length = 0
+            else:
+                # Text before the first record is a record of its own
+                f_started = True
+                i_length += len( str_line.rstrip() )
+    if f_started:
+        ai_lengths.append( i_length )
+    return ai_lengths
+
+
+def func_balance_bases( ai_lengths, i_shards ):
+    """
+    Assign records to shards so each shard has about the same number of bases.
+    Greedy bin-packing, longest record first to the shard with the fewest bases.
+    Returns [ array of the shard ( 0 based ) for each record, list of bases per shard ].
+
+    * ai_lengths : Array
+                 : Sequence length of each record
+    * i_shards : Integer
+               : Number of shards
+    """
+
+    ai_shards = array.array( "L", [ 0 ] * len( ai_lengths ) )
+    li_bases = [ 0 ] * i_shards
+    # Heap of [ bases, shard ] so the lightest shard is on top
+    lli_heap = [ [ 0, i_shard ] for i_shard in xrange( i_shards ) ]
+    for i_record in sorted( xrange( len( ai_lengths ) ), key = ai_lengths.__getitem__, reverse = True ):
+        li_shard = heapq.heappop( lli_heap )
+        li_shard[ 0 ] += ai_lengths[ i_record ]
+        ai_shards[ i_record ] = li_shard[ 1 ]
+        li_bases[ li_shard[ 1 ] ] = li_shard[ 0 ]
+        heapq.heappush( lli_heap, li_shard )
+    return [ ai_shards, li_bases ]
+
+
+def func_make_output_dir( str_output, set_made_dirs ):
+    """
+    Make the directory of an output file if needed.
+
+    * str_output : String
+                 : Path of the output file
+    * set_made_dirs : Set
+                    : Directories already made, updated
+    """
+
+    str_output_dir = os.path.dirname( str_output )
+    if str_output_dir and not str_output_dir in set_made_dirs:
+        # Other processes may be making the same directory
+        try:
+            os.makedirs( str_output_dir )
+        except OSError:
+            if not os.path.isdir( str_output_dir ):
+                raise
+        set_made_dirs.add( str_output_dir )
+
+
+def func_write_fai( str_fasta_file ):
+    """
+    Make a samtools faidx compatible index ( <fasta>.fai ) in one streaming pass.
+    Each line is NAME LENGTH OFFSET LINEBASES LINEWIDTH, tab delimited.
+    Like samtools, every sequence line of a record but the last must be the same length.
+    Returns the path to the index.
+
+    * str_fasta_file : String
+                     : Path to the multi-fasta file
+    """
+
+    str_fai = str_fasta_file + STR_FAI_EXT
+    llstr_index = []
+    # [ name, length, offset, line bases, line width ] of the current record
+    l_record = None
+    # Set when a short line was seen, another sequence line after it is an error
+    f_short_line = False
+    i_offset = 0
+    with open( str_fasta_file, "rb" ) as hndl_fasta:
+        for str_line in hndl_fasta:
+            i_line_width = len( str_line )
+            i_offset += i_line_width
+            if str_line[ 0 ] == ">":
+                if l_record:
+                    llstr_index.append( l_record )
+                lstr_name = str_line[ 1: ].split( None, 1 )
+                l_record = [ lstr_name[ 0 ] if lstr_name else "", 0, i_offset, 0, 0 ]
+                f_short_line = False
+                continue
+            if not l_record:
+                continue
+            i_line_bases = len( str_line.rstrip( "\r\n" ) )
+            if not i_line_bases:
+                f_short_line = True
+                continue
+            if f_short_line:
+                raise ValueError( "Different line length in sequence " + l_record[ 0 ] + ", can not index." )
+            if not l_record[ 3 ]:
+                l_record[ 3 ] = i_line_bases
+                l_record[ 4 ] = i_line_width
+            elif i_line_bases > l_record[ 3 ]:
+                raise ValueError( "Different line length in sequence " + l_record[ 0 ] + ", can not index." )
+            elif i_line_bases < l_record[ 3 ]:
+                # Only the last line may be shorter
+                f_short_line = True
+            l_record[ 1 ] += i_line_bases
+    if l_record:
+        llstr_index.append( l_record )
+
+    with open( str_fai, "w" ) as hndl_fai:
+        hndl_fai.writelines( [ "\t".join( [ str( x_value ) for x_value in l_record ] ) + "\n" for l_record in llstr_index ] )
+    return str_fai
+
+
+def func_read_fai( str_fasta_file ):
+    """
+    Read the faidx index of a fasta file, making it first if it is missing or older than the fasta.
+    Returns { name : [ length, offset, line bases, line width ] }.
+
+    * str_fasta_file : String
+                     : Path to the multi-fasta file
+    """
+
+    str_fai = str_fasta_file + STR_FAI_EXT
+    if not os.path.exists( str_fai ) or ( os.path.getmtime( str_fai ) < os.path.getmtime( str_fasta_file ) ):
+        func_write_fai( str_fasta_file )
+    dict_index = {}
+    with open( str_fai, "r" ) as hndl_fai:
+        for str_line in hndl_fai:
+            lstr_line = str_line.rstrip( "\n" ).split( "\t" )
+            dict_index[ lstr_line[ 0 ] ] = [ int( str_value ) for str_value in lstr_line[ 1:5 ] ]
+    return dict_index
+
+
+def func_parse_region( str_region, dict_index ):
+    """
+    Parse name or name:start-end ( 1 based, inclusive ) into [ name, start, end ], None if the name is not indexed or the range is malformed.
+    A name which itself has a : is matched whole first, as samtools does.
+
+    * str_region : String
+                 : Region to parse
+    * dict_index : Dictionary
+                 : Index from func_read_fai
+    """
+
+    if str_region in dict_index:
+        return [ str_region, 1, dict_index[ str_region ][ 0 ] ]
+    if not ":" in str_region:
+        return None
+    str_name, str_range = str_region.rsplit( ":", 1 )
+    if not str_name in dict_index:
+        return None
+    lstr_range = str_range.replace( ",", "" ).split( "-" )
+    if len( lstr_range ) > 2:
+        return None
+    try:
+        i_start = max( 1, int( lstr_range[ 0 ] ) ) if lstr_range[ 0 ] else 1
+        i_end = int( lstr_range[ 1 ] ) if len( lstr_range ) > 1 and lstr_range[ 1 ] else dict_index[ str_name ][ 0 ]
+    except ValueError:
+        return None
+    return [ str_name, i_start, min( i_end, dict_index[ str_name ][ 0 ] ) ]
+
+
+def func_fetch( mmap_fasta, l_entry, i_start, i_end ):
+    """
+    Get the bases between two 1 based, inclusive positions of an indexed record straight from the mapped file.
+
+    * mmap_fasta : mmap
+                 : Memory map of the fasta file
+    * l_entry : List
+              : [ length, offset, line bases, line width ] from the index
+    * i_start : Integer
+              : First position
+    * i_end : Integer
+            : Last position
+    """
+
+    i_length, i_offset, i_line_bases, i_line_width = l_entry
+    if i_end < i_start or not i_line_bases:
+        return ""
+    i_first = i_offset + ( ( i_start - 1 ) // i_line_bases ) * i_line_width + ( ( i_start - 1 ) % i_line_bases )
+    i_last = i_offset + ( ( i_end - 1 ) // i_line_bases ) * i_line_width + ( ( i_end - 1 ) % i_line_bases )
+    return mmap_fasta[ i_first : i_last + 1 ].translate( None, "\r\n" )
+
+
+def func_extract( str_fasta_file, lstr_regions, hndl_out ):
+    """
+    Write the given regions as fasta, reading only those bases through the index and a memory map.
+    Returns the regions which were not found.
+
+    * str_fasta_file : String
+                     : Path to the multi-fasta file
+    * lstr_regions : List
+                   : Regions, name or name:start-end
+    * hndl_out : File handle
+               : Where to write the fasta
+    """
+
+    dict_index = func_read_fai( str_fasta_file )
+    lstr_missing = []
+    with open( str_fasta_file, "rb" ) as hndl_fasta:
+        if not os.path.getsize( str_fasta_file ):
+            return list( lstr_regions )
+        mmap_fasta = mmap.mmap( hndl_fasta.fileno(), 0, access = mmap.ACCESS_READ )
+        try:
+            for str_region in lstr_regions:
+                l_region = func_parse_region( str_region, dict_index )
+                if not l_region:
+                    lstr_missing.append( str_region )
+                    continue
+                str_name, i_start, i_end = l_region
+                str_seq = func_fetch( mmap_fasta, dict_index[ str_name ], i_start, i_end )
+                hndl_out.write( ">" + str_region + "\n" )
+                hndl_out.writelines( [ str_seq[ i_line : i_line + I_EXTRACT_WIDTH ] + "\n" for i_line in xrange( 0, len( str_seq ), I_EXTRACT_WIDTH ) ] )
+        finally:
+            mmap_fasta.close()
+    return lstr_missing
+
+
+def func_find_ranges( str_fasta_file, i_processes ):
+    """
+    Cut the fasta file into about equal byte ranges which each start at a record ( a > at the start of a line ).
+    Returns [ [ start, end ], ... ], empty for an empty file.
+
+    * str_fasta_file : String
+                     : Path to the multi-fasta file
+    * i_processes : Integer
+                  : Number of ranges wanted
+    """
+
+    i_size = os.path.getsize( str_fasta_file )
+    if not i_size:
+        return []
+    li_starts = [ 0 ]
+    with open( str_fasta_file, "rb" ) as hndl_fasta:
+        mmap_fasta = mmap.mmap( hndl_fasta.fileno(), 0, access = mmap.ACCESS_READ )
+        try:
+            for i_range in xrange( 1, i_processes ):
+                i_cut = max( li_starts[ -1 ] + 1, ( i_size * i_range ) // i_processes )
+                i_boundary = mmap_fasta.find( "\n>", i_cut - 1 )
+                if i_boundary < 0:
+                    break
+                if i_boundary + 1 > li_starts[ -1 ]:
+                    li_starts.append( i_boundary + 1 )
+        finally:
+            mmap_fasta.close()
+    return [ [ i_start, i_end ] for i_start, i_end in zip( li_starts, li_starts[ 1: ] + [ i_size ] ) ]
+
+
+def func_range_base( str_file_base, i_range ):
+    """
+    Base name of the provisional files of one byte range in the parallel split, hidden and unlike any final name.
+
+    * str_file_base : String
+                    : Base name of the input file
+    * i_range : Integer
+              : Number of the byte range
+    """
+
+    return "".join( [ ".", str_file_base, ".range", str( i_range ) ] )
+
+
+def func_split_range( lx_args ):
+    """
+    Worker splitting one byte range of the fasta file into files under provisional names numbered from 1 within the range
+    ( func_range_base ), as the first file number of the range is only known once all ranges are counted.
+    Returns the number of records in the range.
+
+    * lx_args : List
+              : [ path to the fasta file, start, end, range number, file base, hash dirs ]
+    """
+
+    str_fasta_file, i_start, i_end, i_range, str_file_base, i_hash_dirs = lx_args
+    str_range_base = func_range_base( str_file_base, i_range )
+    i_records = 0
+    set_made_dirs = set()
+    with open( str_fasta_file, "rb" ) as hndl_fasta:
+        mmap_fasta = mmap.mmap( hndl_fasta.fileno(), 0, access = mmap.ACCESS_READ )
+        try:
+            i_position = i_start
+            while i_position < i_end:
+                i_next = mmap_fasta.find( "\n>", i_position, i_end )
+                i_record_end = i_end if i_next < 0 else i_next + 1
+                i_records += 1
+                str_output = func_output_path( str_range_base, i_records, i_hash_dirs )
+                func_make_output_dir( str_output, set_made_dirs )
+                with open( str_output, "wb" ) as hndl_write:
+                    hndl_write.write( mmap_fasta[ i_position : i_record_end ] )
+                i_position = i_record_end
+        finally:
+            mmap_fasta.close()
+    return i_records
+
+
+def func_rename_range( lx_args ):
+    """
+    Worker giving the provisional files of one byte range their final <base>_<i>.fasta names.
+
+    * lx_args : List
+              : [ range number, records in the range, first counter of the range, file base, hash dirs ]
+    """
+
+    i_range, i_records, i_counter, str_file_base, i_hash_dirs = lx_args
+    str_range_base = func_range_base( str_file_base, i_range )
+    set_made_dirs = set()
+    for i_record in xrange( i_records ):
+        str_output = func_output_path( str_file_base, i_counter + i_record, i_hash_dirs )
+        func_make_output_dir( str_output, set_made_dirs )
+        os.rename( func_output_path( str_range_base, i_record + 1, i_hash_dirs ), str_output )
+
+
+def func_split_parallel( str_fasta_file, i_processes, i_hash_dirs ):
+    """
+    Split a fasta into one file per record with a pool of processes, each working on its own byte range of a memory map.
+    The fasta is read once: ranges write under provisional names while counting their records, then the files are
+    renamed so every file gets the same <base>_<i>.fasta name as in the serial split.
+    Returns the number of files written.
+
+    * str_fasta_file : String
+                     : Path to the multi-fasta file
+    * i_processes : Integer
+                  : Number of worker processes
+    * i_hash_dirs : Integer
+                  : Number of subdirectories to spread files over, 0 for none
+    """
+
+    str_file_base = os.path.splitext( os.path.basename( str_fasta_file ) )[0]
+    lli_ranges = func_find_ranges( str_fasta_file, i_processes )
+    pool_workers = multiprocessing.Pool( i_processes )
+    try:
+        li_counts = pool_workers.map( func_split_range, [ [ str_fasta_file, li_range[ 0 ], li_range[ 1 ], i_range, str_file_base, i_hash_dirs ] for i_range, li_range in enumerate( lli_ranges ) ] )
+        # Each range starts numbering after the records of the ranges before it
+        li_counters = [ 1 ]
+        for i_count in li_counts[ :-1 ]:
+            li_counters.append( li_counters[ -1 ] + i_count )
+        pool_workers.map( func_rename_range, [ [ i_range, li_counts[ i_range ], li_counters[ i_range ], str_file_base, i_hash_dirs ] for i_range in xrange( len( lli_ranges ) ) ] )
+        pool_workers.close()
+    except:
+        pool_workers.terminate()
+        raise
+    finally:
+        pool_workers.join()
+    return sum( li_counts )
 
 
 # Parse arguments
 prsr_arguments = argparse.ArgumentParser( prog = "splitFasta.py", description = "Splits a multi fasta file into one file per fasta" )
 prsr_arguments.add_argument( "str_fasta_file" , help = "Multi-fasta file to split." )
+prsr_arguments.add_argument( "-r", "--records", type = int, metavar = "Records_Per_File", dest = "i_records", default = 1, help = "Number of fasta records per file." )
+prsr_arguments.add_argument( "-b", "--max_bytes", type = int, metavar = "Max_Bytes", dest = "i_max_bytes", default = 0, help = "Start a new file before a file grows over this many bytes ( a single larger record gets a file of its own ). 0 for no limit." )
+prsr_arguments.add_argument( "--hash_dirs", type = int, metavar = "Subdirectories", dest = "i_hash_dirs", default = 0, help = "Spread the files over this many hashed subdirectories instead of one flat directory. 0 for none." )
+prsr_arguments.add_argument( "--balance_bases", "--balance-bases", type = int, metavar = "Shards", dest = "i_balance_shards", default = 0, help = "Split into this many shards ( <base>_<i>.fasta ) with about the same number of bases each, for parallel BLAST / alignment. Record order is kept within a shard." )
+prsr_arguments.add_argument( "--index", dest = "f_index", action = "store_true", default = False, help = "Only make a samtools faidx compatible index ( <fasta>.fai ) instead of splitting." )
+prsr_arguments.add_argument( "--extract", metavar = "Region", dest = "lstr_regions", nargs = "+", default = None, help = "Instead of splitting, write these regions ( name or name:start-end, 1 based ) to stdout using the .fai index, which is made if needed." )
+prsr_arguments.add_argument( "--extract_file", metavar = "Region_File", dest = "str_region_file", default = None, help = "File of regions to extract, one per line." )
+prsr_arguments.add_argument( "-p", "--processes", type = int, metavar = "Processes", dest = "i_processes", default = 1, help = "Split one record per file with this many processes, each on its own byte range of the memory mapped fasta. Files are named as in the serial split." )
 args = prsr_arguments.parse_args()
 
 
+# Index only
+if args.f_index:
+    print "Wrote index " + func_write_fai( args.str_fasta_file )
+    exit( 0 )
+
+# Random access extraction instead of splitting
+if args.lstr_regions or args.str_region_file:
+    lstr_regions = list( args.lstr_regions or [] )
+    if args.str_region_file:
+        with open( args.str_region_file, "r" ) as hndl_regions:
+            lstr_regions.extend( [ str_region.strip() for str_region in hndl_regions if str_region.strip() ] )
+    lstr_missing = func_extract( args.str_fasta_file, lstr_regions, sys.stdout )
+    if lstr_missing:
+        sys.stderr.write( "Regions not found: " + " ".join( lstr_missing ) + "\n" )
+        exit( 1 )
+    exit( 0 )
+
+
+# Parallel split, only one record per file keeps numbering independent between ranges
+if args.i_processes > 1:
+    if args.i_records == 1 and not args.i_max_bytes and not args.i_balance_shards:
+        print "Wrote " + str( func_split_parallel( args.str_fasta_file, args.i_processes, args.i_hash_dirs ) ) + " files."
+        exit( 0 )
+    print "Processes are only used when splitting one record per file, splitting serially."
+
+
+# Base balanced shards, measure first then write every shard in one more pass
+if args.i_balance_shards > 0:
+    str_file_base = os.path.splitext( os.path.basename( args.str_fasta_file ) )[0]
+    ai_shards, li_bases = func_balance_bases( func_measure_records( args.str_fasta_file ), args.i_balance_shards )
+    set_made_dirs = set()
+    lhndl_shards = []
+    for i_shard in xrange( args.i_balance_shards ):
+        str_output = func_output_path( str_file_base, i_shard + 1, args.i_hash_dirs )
+        func_make_output_dir( str_output, set_made_dirs )
+        lhndl_shards.append( open( str_output, "w" ) )
+    with open( args.str_fasta_file, "r" ) as hndl_fasta:
+        for i_record, lstr_content in enumerate( func_iter_records( hndl_fasta ) ):
+            lhndl_shards[ ai_shards[ i_record ] ].writelines( lstr_content )
+    for hndl_shard in lhndl_shards:
+        hndl_shard.close()
+    print "Bases per shard: " + " ".join( [ str( i_bases ) for i_bases in li_bases ] )
+    exit( 0 )
+
+
 with open( args.str_fasta_file, "r" ) as hndl_fasta:
 
     str_file_base = os.path.splitext( os.path.basename( args.str_fasta_file ) )[0]
-    lstr_content = []
-    f_write = False
-    i_counter = 1
-    for str_line in hndl_fasta:
-        if str_line[0] == ">":
-            f_write = True
-        else:
-            f_write = False
-        if f_write and len( lstr_content ) > 0:
-            with open( "".join( [ str_file_base, "_", str( i_counter ), ".fasta" ] ), "w"  ) as hndl_write:
-                hndl_write.writelines( lstr_content )
-                lstr_content = []
-                i_counter += 1
-        lstr_content.append( str_line )
-        
-    if len( lstr_content ) > 0:
-            with open( "".join( [ str_file_base, "_", str( i_counter ), ".fasta" ] ), "w"  ) as hndl_write:
-                hndl_write.writelines( lstr_content )
\ No newline at end of file
+    i_counter = 0
+    hndl_write = None
+    i_file_records = 0
+    i_file_bytes = 0
+    set_made_dirs = set()
+    for lstr_content in func_iter_records( hndl_fasta ):
+
+        # Keep writing to the open file until it is full
+        i_record_bytes = sum( [ len( str_line ) for str_line in lstr_content ] )
+        if ( hndl_write is None or ( i_file_records >= args.i_records ) or
+             ( args.i_max_bytes and ( i_file_records > 0 ) and ( i_file_bytes + i_record_bytes > args.i_max_bytes ) ) ):
+            if hndl_write:
+                hndl_write.close()
+            i_counter += 1
+            str_output = func_output_path( str_file_base, i_counter, args.i_hash_dirs )
+            func_make_output_dir( str_output, set_made_dirs )
+            hndl_write = open( str_output, "w" )
+            i_file_records = 0
+            i_file_bytes = 0
+
+        hndl_write.writelines( lstr_content )
+        i_file_records += 1
+        i_file_bytes += i_record_bytes
+
+    if hndl_write:
+        hndl_write.close()